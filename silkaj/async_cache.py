@@ -0,0 +1,83 @@
+"""
+Copyright  2016-2021 Maël Azimi <m.a@moul.re>
+
+Silkaj is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Silkaj is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from time import monotonic
+from asyncio import ensure_future, shield
+
+# The cache’s TTL, as a key’s TTL can be None
+DEFAULT_TTL = object()
+
+
+class AsyncCache(object):
+    """
+    Results of coroutine functions by key, kept `ttl` seconds, forever when None.
+    Concurrent awaits of a missing key share a single call.
+    Failures are not cached
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.entries = dict()
+        self.pending = dict()
+        self.hits, self.misses, self.shared = 0, 0, 0
+
+    async def get(self, key, fetch, ttl=DEFAULT_TTL):
+        """
+        Returns the cached value of `key`, or awaits `fetch()` to get it.
+        `ttl` overrides the cache’s one for this key
+        """
+        ttl = self.ttl if ttl is DEFAULT_TTL else ttl
+        entry = self.entries.get(key)
+        if entry is not None and (entry[1] is None or monotonic() < entry[1]):
+            self.hits += 1
+            return entry[0]
+        task = self.pending.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.misses += 1
+            task = ensure_future(fetch())
+            self.pending[key] = task
+            task.add_done_callback(lambda task: self.settle(key, task, ttl))
+        # A cancelled caller does not cancel the call the others wait for
+        return await shield(task)
+
+    def settle(self, key, task, ttl):
+        # The key was invalidated while its value was fetched
+        if self.pending.get(key) is not task:
+            return
+        del self.pending[key]
+        if not task.cancelled() and task.exception() is None:
+            expiry = None if ttl is None else monotonic() + ttl
+            self.entries[key] = (task.result(), expiry)
+
+    def invalidate(self, key=None):
+        """Forget `key`, all the keys when None"""
+        if key is None:
+            self.entries.clear()
+            self.pending.clear()
+        else:
+            self.entries.pop(key, None)
+            self.pending.pop(key, None)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "size": len(self.entries),
+        }
@@ -15,37 +15,261 @@ You should have received a copy of the GNU Affero General Public License
 along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 """
 
-from silkaj.network_tools import ClientInstance
+import json
+import logging
+import jsonschema
+from os import replace
+from time import monotonic, time
+from asyncio import (
+    sleep,
+    gather,
+    ensure_future,
+    Event,
+    CancelledError,
+    TimeoutError,
+)
+from aiohttp.client_exceptions import ClientError
+from duniterpy.api import bma
 from duniterpy.api.bma import blockchain
+from duniterpy.api.errors import DuniterError
 
+from silkaj.network_tools import ClientInstance, EndPoint
+from silkaj.async_cache import AsyncCache
+from silkaj.constants import (
+    HEAD_BLOCK_TTL,
+    PARAMS_CACHE_TTL,
+    HEAD_POLL_INTERVAL,
+    HEAD_RECONNECT_DELAY,
+    HEAD_RECONNECT_MAX_DELAY,
+    HEAD_WS_TIMEOUT,
+)
 
-class BlockchainParams(object):
-    __instance = None
+# A closed websocket raises TypeError on receive_json()
+WATCH_ERRORS = (
+    ClientError,
+    OSError,
+    TimeoutError,
+    ValueError,
+    TypeError,
+    DuniterError,
+    jsonschema.ValidationError,
+)
+PARAMS_CACHE_FILENAME = "blockchain_params.json"
 
-    def __new__(cls):
-        if BlockchainParams.__instance is None:
-            BlockchainParams.__instance = object.__new__(cls)
-        return BlockchainParams.__instance
 
-    def __init__(self):
-        self.params = self.get_params()
+class BlockchainParams(object):
+    cache = AsyncCache()
+
+    @property
+    def params(self):
+        return BlockchainParams.cache.get("params", self.get_params)
 
     async def get_params(self):
+        """
+        Returns the cached parameters of the currency, with no request.
+        Once PARAMS_CACHE_TTL passed, the genesis block is requested
+        to detect a restarted currency
+        """
+        cache = ParamsCache()
+        source = params_source()
+        params = cache.lookup(source)
+        if params is not None:
+            return params
         client = ClientInstance().client
-        return await client(blockchain.parameters)
+        if cache.known(source):
+            genesis = await client(blockchain.block, 0)
+            params = cache.confirm(source, genesis)
+            if params is not None:
+                cache.save()
+                return params
+        params, genesis = await gather(
+            client(blockchain.parameters), client(blockchain.block, 0)
+        )
+        cache.record(source, genesis, params)
+        cache.save()
+        return params
 
 
-class HeadBlock(object):
-    __instance = None
+def params_source():
+    """
+    The network the parameters come from: the currency of the default
+    network, or the node a peer is pinned to
+    """
+    endpoint = EndPoint()
+    if endpoint.pinned:
+        return endpoint.BMA_ENDPOINT
+    return "g1-test" if endpoint.gtest else "g1"
 
-    def __new__(cls):
-        if HeadBlock.__instance is None:
-            HeadBlock.__instance = object.__new__(cls)
-        return HeadBlock.__instance
+
+class ParamsCache(object):
+    """
+    Currencies’ parameters, fixed at their genesis, stored in the cache directory
+    by currency name and genesis block hash.
+    The sources record which currency a network or a node was last checked on.
+    Kept in memory only when the cache directory can not be written
+    """
 
     def __init__(self):
-        self.head_block = self.get_head()
+        # silkaj.tools imports this module
+        from silkaj.tools import get_cache_dir
+
+        self.path = None
+        try:
+            self.path = get_cache_dir() / PARAMS_CACHE_FILENAME
+            with self.path.open() as cache_file:
+                cache = json.load(cache_file)
+            self.parameters, self.sources = cache["parameters"], cache["sources"]
+        except (OSError, ValueError, KeyError):
+            self.parameters, self.sources = dict(), dict()
+
+    def known(self, source):
+        return self.sources.get(source, dict()).get("key") in self.parameters
+
+    def lookup(self, source):
+        """Returns the parameters of the source, None when unknown or to check"""
+        if not self.known(source):
+            return None
+        if time() - self.sources[source]["checked"] >= PARAMS_CACHE_TTL:
+            return None
+        return self.parameters[self.sources[source]["key"]]
+
+    def confirm(self, source, genesis):
+        """
+        Returns the parameters of the source if it is still on the same
+        currency, from its genesis block. None otherwise
+        """
+        key = self.sources[source]["key"]
+        if key != params_key(genesis):
+            return None
+        self.sources[source]["checked"] = time()
+        return self.parameters[key]
+
+    def record(self, source, genesis, params):
+        key = params_key(genesis)
+        self.parameters[key] = params
+        self.sources[source] = {"key": key, "checked": time()}
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            with tmp_path.open("w") as cache_file:
+                json.dump(
+                    {"parameters": self.parameters, "sources": self.sources},
+                    cache_file,
+                )
+            replace(str(tmp_path), str(self.path))
+        except OSError:
+            self.path = None
+
+
+def params_key(genesis):
+    return "{}:{}".format(genesis["currency"], genesis["hash"])
+
+
+class HeadBlock(object):
+    cache = AsyncCache(HEAD_BLOCK_TTL)
+
+    @property
+    def head_block(self):
+        return HeadBlock.cache.get("head_block", self.get_head)
 
     async def get_head(self):
+        if head_watcher.running():
+            return await head_watcher.current()
         client = ClientInstance().client
         return await client(blockchain.current)
+
+
+class HeadBlockWatcher(object):
+    """
+    Keeps the head block up to date in the background, for long-running
+    commands: follows the `ws/block` websocket, polls `blockchain/current`
+    every HEAD_POLL_INTERVAL while the websocket is down, and reconnects
+    with an exponential backoff.
+    Once started, `HeadBlock().head_block` is served from it.
+    Use the module’s `head_watcher` instance
+    """
+
+    def __init__(self):
+        self.task = None
+
+    def running(self):
+        return self.task is not None
+
+    def start(self):
+        if self.running():
+            return
+        self.client = ClientInstance().client
+        self.head, self.updated_at = None, None
+        self.changed = Event()
+        self.delay = HEAD_RECONNECT_DELAY
+        self.task = ensure_future(self.watch())
+
+    async def stop(self):
+        if not self.running():
+            return
+        task, self.task = self.task, None
+        task.cancel()
+        try:
+            await task
+        except CancelledError:
+            pass
+
+    async def current(self):
+        """Returns the head block, waits for the first one when starting"""
+        return await self.new_head(None)
+
+    async def new_head(self, head):
+        """Waits for a head block other than `head`, and returns it"""
+        while self.head is head:
+            await self.changed.wait()
+        return self.head
+
+    def update(self, block):
+        if self.head is not None and block["number"] < self.head["number"]:
+            return
+        self.head, self.updated_at = block, monotonic()
+        HeadBlock.cache.invalidate()
+        changed, self.changed = self.changed, Event()
+        changed.set()
+
+    async def watch(self):
+        while True:
+            try:
+                await self.follow_websocket()
+            except WATCH_ERRORS as e:
+                logging.warning(
+                    "Head block websocket {}: {}".format(type(e).__name__, e)
+                )
+            await self.poll(monotonic() + self.delay)
+            self.delay = min(self.delay * 2, HEAD_RECONNECT_MAX_DELAY)
+
+    async def follow_websocket(self):
+        ws = await self.client(bma.ws.block)
+        try:
+            # The websocket only sends the blocks to come
+            self.update(await self.client(blockchain.current))
+            while True:
+                block = await ws.receive_json(timeout=HEAD_WS_TIMEOUT)
+                jsonschema.validate(block, bma.ws.WS_BLOCK_SCHEMA)
+                self.update(block)
+                self.delay = HEAD_RECONNECT_DELAY
+        finally:
+            await ws.close()
+
+    async def poll(self, deadline):
+        """Polls the head block until the deadline, at least once"""
+        while True:
+            try:
+                self.update(await self.client(blockchain.current))
+            except WATCH_ERRORS as e:
+                logging.warning("Head block request {}: {}".format(type(e).__name__, e))
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return
+            await sleep(min(HEAD_POLL_INTERVAL, remaining))
+
+
+head_watcher = HeadBlockWatcher()
@@ -15,21 +15,48 @@ You should have received a copy of the GNU Affero General Public License
 along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 """
 
+import re
+import json
 import logging
-from asyncio import sleep
-from click import command, argument, INT, progressbar
-from aiohttp.client_exceptions import ServerDisconnectedError
+from base64 import b64decode
+from collections import deque
+from sys import stderr
+from time import monotonic
+from random import uniform
+from os import cpu_count, replace
+from asyncio import sleep, gather, get_event_loop, ensure_future, Queue, TimeoutError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from click import command, argument, option, INT, IntRange, Choice, progressbar
+from aiohttp.client_exceptions import ClientError
 
 from duniterpy.api import bma
-from duniterpy.api.client import Client
-from duniterpy.api.errors import DuniterError
+from duniterpy.api.errors import DuniterError, HTTP_LIMITATION
 from duniterpy.documents import Block
 from duniterpy.key.verifying_key import VerifyingKey
 
-from silkaj.tools import message_exit, coroutine
-from silkaj.network_tools import EndPoint
+from silkaj.tools import message_exit, coroutine, get_cache_dir
+from silkaj.network_tools import (
+    EndPoint,
+    ClientInstance,
+    PooledClient,
+    TokenBucket,
+    parse_peer,
+    get_peers_among_leaves,
+    generate_duniterpy_endpoint_format,
+)
+from silkaj.blocks_store import BlocksStore
 from silkaj.constants import BMA_MAX_BLOCKS_CHUNK_SIZE
 
+CHECKPOINT_FILENAME = "verify_checkpoint.json"
+CHUNK_MIN_SIZE = 50
+CHUNK_TARGET_LATENCY = 5
+MAX_RETRIES = 6
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+MAX_DISCOVERED_PEERS = 8
+RAW_SIGNED_TAIL = re.compile("InnerHash: [0-9A-F]{64}\nNonce: [0-9]+\n")
+REPORTED_BLOCKS = ("invalid_blocks_signatures", "wrong_hashes", "chain_breaks")
+
 
 @command(
     "verify",
@@ -39,32 +66,239 @@ If nothing specified, the whole blockchain gets verified.",
 )
 @argument("from_block", default=0, type=INT)
 @argument("to_block", default=0, type=INT)
+@option(
+    "--jobs",
+    "-j",
+    type=IntRange(1),
+    help="Number of processes verifying the blocks’ signatures in parallel. \
+Defaults to the number of CPUs",
+)
+@option(
+    "--prefetch",
+    default=2,
+    show_default=True,
+    type=IntRange(1),
+    help="Number of chunks downloaded in advance while verifying the current one",
+)
+@option(
+    "--resume",
+    "-r",
+    is_flag=True,
+    help="Resume the last interrupted verification from its checkpoint. \
+FROM_BLOCK and TO_BLOCK are taken from the checkpoint",
+)
+@option(
+    "--chain",
+    "-c",
+    is_flag=True,
+    help="Also verify the blocks’ InnerHash and hashes, and that each block is linked \
+to the previous one by its PreviousHash",
+)
+@option(
+    "peers",
+    "--peer",
+    multiple=True,
+    help="Additional node to download the blocks from: <host>:<port>. \
+Can be passed multiple times",
+)
+@option(
+    "--discover",
+    "-d",
+    is_flag=True,
+    help="Also download the blocks from nodes discovered among the node’s peers",
+)
+@option(
+    "output_format",
+    "--format",
+    type=Choice(["text", "jsonl"]),
+    default="text",
+    show_default=True,
+    help="Output format. jsonl writes one JSON record per verified chunk \
+as it finishes, then a summary record",
+)
+@option(
+    "--full-parse",
+    is_flag=True,
+    help="Parse every block before checking its signature, instead of checking \
+it on the raw block and parsing only the blocks failing this check",
+)
 @coroutine
-async def verify_blocks_signatures(from_block, to_block):
-    client = Client(EndPoint().BMA_ENDPOINT)
-    to_block = await check_passed_blocks_range(client, from_block, to_block)
-    invalid_blocks_signatures = list()
-    chunks_from = range(from_block, to_block + 1, BMA_MAX_BLOCKS_CHUNK_SIZE)
-    with progressbar(chunks_from, label="Processing blocks verification") as bar:
-        for chunk_from in bar:
+async def verify_blocks_signatures(
+    from_block,
+    to_block,
+    jobs,
+    prefetch,
+    resume,
+    chain,
+    peers,
+    discover,
+    output_format,
+    full_parse,
+):
+    if jobs is None:
+        jobs = cpu_count() or 1
+    client = ClientInstance().client
+    checkpoint_path = get_cache_dir() / CHECKPOINT_FILENAME
+    if resume:
+        checkpoint = load_checkpoint(checkpoint_path)
+        if checkpoint is None:
+            await client.close()
+            message_exit("No interrupted verification to resume")
+        from_block, to_block = checkpoint["from_block"], checkpoint["to_block"]
+        chain = checkpoint["chain"]
+    to_block, head = await check_passed_blocks_range(client, from_block, to_block)
+    if not resume:
+        checkpoint = {
+            "currency": head["currency"],
+            "from_block": from_block,
+            "to_block": to_block,
+            "last_verified": from_block - 1,
+            "invalid_blocks_signatures": list(),
+            "chain": chain,
+            "last_hash": None,
+            "wrong_hashes": list(),
+            "chain_breaks": list(),
+        }
+        save_checkpoint(checkpoint_path, checkpoint)
+    elif checkpoint["currency"] != head["currency"]:
+        await client.close()
+        message_exit(
+            "Checkpoint currency {} does not match the node’s one".format(
+                checkpoint["currency"]
+            )
+        )
+    resume_from = checkpoint["last_verified"] + 1
+    store = BlocksStore(head["currency"], head["number"])
+    await store.check_tip(client)
+    peers_clients = [
+        PooledClient(endpoint)
+        for endpoint in await get_peers_endpoints(client, peers, discover)
+    ]
+    if peers_clients:
+        fetcher = MultiNodeFetcher([client] + peers_clients, store.last_stable_number)
+    else:
+        fetcher = ChunkFetcher(client)
+    chunks_from = range(resume_from, to_block + 1, BMA_MAX_BLOCKS_CHUNK_SIZE)
+    executor = verification_executor(jobs)
+    chunks = Queue(prefetch)
+    producer = ensure_future(
+        fetch_chunks(fetcher, store, resume_from, to_block, chunks_from, chunks)
+    )
+    # Keep stdout to the JSON records
+    bar_file = stderr if output_format == "jsonl" else None
+    try:
+        with progressbar(
+            chunks_from, label="Processing blocks verification", file=bar_file
+        ) as bar:
+            chunk_start = monotonic()
+            for _ in bar:
+                chunk = await chunks.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                lengths = {key: len(checkpoint[key]) for key in REPORTED_BLOCKS}
+                for report in await verify_chunk(
+                    executor, jobs, chunk, chain, full_parse
+                ):
+                    merge_report(checkpoint, report)
+                checkpoint["last_verified"] = chunk[-1]["number"]
+                save_checkpoint(checkpoint_path, checkpoint)
+                if output_format == "jsonl":
+                    display_chunk_record(
+                        checkpoint, lengths, chunk, monotonic() - chunk_start
+                    )
+                chunk_start = monotonic()
+    except BaseException:
+        print(
+            "Verification interrupted at block {}. \
+Run `silkaj verify --resume` to continue it".format(
+                checkpoint["last_verified"] + 1
+            ),
+            file=stderr,
+        )
+        raise
+    finally:
+        producer.cancel()
+        executor.shutdown()
+        store.close()
+        for peer_client in peers_clients:
+            await peer_client.close()
+        await client.close()
+    if checkpoint_path.exists():
+        checkpoint_path.unlink()
+    if output_format == "jsonl":
+        display_summary_record(from_block, to_block, checkpoint)
+        return
+    display_result(from_block, to_block, checkpoint["invalid_blocks_signatures"])
+    if chain:
+        display_chain_result(
+            from_block, to_block, checkpoint["wrong_hashes"], checkpoint["chain_breaks"]
+        )
+
+
+def load_checkpoint(path):
+    """Returns the checkpoint of the interrupted verification, None if missing"""
+    try:
+        with path.open() as checkpoint_file:
+            return json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(path, checkpoint):
+    """Write the checkpoint into a temporary file, then move it in place,
+    so that an interruption while writing does not corrupt it"""
+    tmp_path = path.with_suffix(".tmp")
+    with tmp_path.open("w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    replace(str(tmp_path), str(path))
+
+
+async def fetch_chunks(fetcher, store, from_block, to_block, chunks_from, chunks):
+    """Producer filling the bounded `chunks` queue in order.
+    Blocks when `prefetch` chunks are waiting to be verified.
+    Up to `fetcher.concurrency` chunks are downloaded at the same time.
+    An exception is passed through the queue to the consumer"""
+    downloads = deque()
+    try:
+        for chunk_from in chunks_from:
             chunk_size = get_chunk_size(from_block, to_block, chunks_from, chunk_from)
             logging.info(
                 "Processing chunk from block {} to {}".format(
                     chunk_from, chunk_from + chunk_size
                 )
             )
-            chunk = await get_chunk(client, chunk_size, chunk_from)
+            downloads.append(
+                ensure_future(get_blocks(fetcher, store, chunk_size, chunk_from))
+            )
+            if len(downloads) >= fetcher.concurrency:
+                await chunks.put(await downloads.popleft())
+        while downloads:
+            await chunks.put(await downloads.popleft())
+    except Exception as e:
+        await chunks.put(e)
+    finally:
+        for download in downloads:
+            download.cancel()
 
-            for block in chunk:
-                block = Block.from_signed_raw(block["raw"] + block["signature"] + "\n")
-                verify_block_signature(invalid_blocks_signatures, block)
 
-    await client.close()
-    display_result(from_block, to_block, invalid_blocks_signatures)
+async def get_peers_endpoints(client, peers, discover):
+    """Returns the BMA endpoints of the passed peers
+    and of the peers discovered from the node when `discover` is set"""
+    endpoints = [generate_duniterpy_endpoint_format(parse_peer(peer)) for peer in peers]
+    if discover:
+        for ep in await get_peers_among_leaves(client):
+            endpoint = generate_duniterpy_endpoint_format(ep)
+            if len(endpoints) >= len(peers) + MAX_DISCOVERED_PEERS:
+                break
+            if endpoint not in endpoints and endpoint != EndPoint().BMA_ENDPOINT:
+                endpoints.append(endpoint)
+    return endpoints
 
 
 async def check_passed_blocks_range(client, from_block, to_block):
-    head_number = (await client(bma.blockchain.current))["number"]
+    """Returns TO_BLOCK, set to the head number if not passed, and the head block"""
+    head = await client(bma.blockchain.current)
+    head_number = head["number"]
     if to_block == 0:
         to_block = head_number
     if to_block > head_number:
@@ -76,7 +310,7 @@ async def check_passed_blocks_range(client, from_block, to_block):
     if from_block > to_block:
         await client.close()
         message_exit("TO_BLOCK should be bigger or equal to FROM_BLOCK")
-    return to_block
+    return to_block, head
 
 
 def get_chunk_size(from_block, to_block, chunks_from, chunk_from):
@@ -85,18 +319,276 @@ def get_chunk_size(from_block, to_block, chunks_from, chunk_from):
     if chunk_from != chunks_from[-1]:
         return BMA_MAX_BLOCKS_CHUNK_SIZE
     else:
-        return (to_block + 1 - from_block) % BMA_MAX_BLOCKS_CHUNK_SIZE
+        return to_block + 1 - chunk_from
+
+
+async def get_blocks(fetcher, store, count, start):
+    """Read the blocks from the local store.
+    Only the blocks missing from it are downloaded, then stored"""
+    blocks = store.get_blocks(count, start)
+    if len(blocks) < count:
+        missing = await fetcher.get_chunk(count - len(blocks), start + len(blocks))
+        store.add_blocks(missing)
+        blocks.extend(missing)
+    return blocks
 
 
 async def get_chunk(client, chunk_size, chunk_from):
+    return await ChunkFetcher(client).get_chunk(chunk_size, chunk_from)
+
+
+class ChunkFetcher(object):
+    """
+    Downloads chunks of blocks with requests paced by a token bucket.
+    The requests size shrinks on errors and slow responses,
+    and grows back up to BMA maximum while responses are fast.
+    Failed requests are retried with an exponential backoff and jitter
+    """
+
+    concurrency = 1
+
+    def __init__(self, client, rate_limiter=None, retries=MAX_RETRIES):
+        self.client = client
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.retries = retries
+        self.size = BMA_MAX_BLOCKS_CHUNK_SIZE
+
+    async def get_chunk(self, chunk_size, chunk_from):
+        """Returns the `chunk_size` blocks from `chunk_from`,
+        requested in as many requests as the current size requires.
+        Raises an error if the node does not return all of them"""
+        chunk = list()
+        while len(chunk) < chunk_size:
+            blocks = await self.request(
+                chunk_size - len(chunk), chunk_from + len(chunk)
+            )
+            if not blocks:
+                raise ValueError(
+                    "Node returned no blocks from block {}".format(
+                        chunk_from + len(chunk)
+                    )
+                )
+            chunk.extend(blocks)
+        return chunk
+
+    async def request(self, count, start):
+        """Request `count` blocks at most, limited by the current size,
+        which is shrunk before each retry"""
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire()
+            begin = monotonic()
+            try:
+                blocks = await self.client(
+                    bma.blockchain.blocks, min(count, self.size), start
+                )
+            except DuniterError as error:
+                if error.ucode != HTTP_LIMITATION:
+                    raise
+                attempt = await self.backoff(attempt, error)
+                continue
+            except (ClientError, TimeoutError) as error:
+                attempt = await self.backoff(attempt, error)
+                continue
+            self.adapt(monotonic() - begin)
+            return blocks
+
+    async def backoff(self, attempt, error):
+        attempt += 1
+        if attempt > self.retries:
+            raise error
+        self.size = max(CHUNK_MIN_SIZE, self.size // 2)
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+        delay = uniform(delay / 2, delay)
+        logging.info(
+            "{}: retrying in {:.1f} seconds with chunks of {} blocks".format(
+                type(error).__name__, delay, self.size
+            )
+        )
+        await sleep(delay)
+        return attempt
+
+    def adapt(self, latency):
+        if latency > CHUNK_TARGET_LATENCY:
+            self.size = max(CHUNK_MIN_SIZE, self.size // 2)
+        elif latency < CHUNK_TARGET_LATENCY / 2:
+            self.size = min(BMA_MAX_BLOCKS_CHUNK_SIZE, self.size * 3 // 2)
+
+
+class MultiNodeFetcher(object):
+    """
+    Spreads the chunks downloads over several nodes, one download per node at a time.
+    A chunk which failed to be downloaded is reassigned to another node,
+    while the failing node is not used anymore.
+    The hash of the chunk’s last stable block is cross-checked with another node
+    """
+
+    def __init__(self, clients, last_stable_number):
+        self.fetchers = [ChunkFetcher(client, retries=1) for client in clients]
+        self.healthy = list(self.fetchers)
+        self.concurrency = len(self.fetchers)
+        self.last_stable_number = last_stable_number
+        self.turn = 0
+
+    def pick(self, excluded, advance=True):
+        """Round-robin over the healthy nodes, except the `excluded` ones"""
+        candidates = [fetcher for fetcher in self.healthy if fetcher not in excluded]
+        if not candidates:
+            return None
+        self.turn += advance
+        return candidates[self.turn % len(candidates)]
+
+    async def get_chunk(self, chunk_size, chunk_from):
+        tried = list()
+        while True:
+            fetcher = self.pick(tried)
+            if fetcher is None:
+                raise ValueError(
+                    "No node left to download blocks from block {}".format(chunk_from)
+                )
+            tried.append(fetcher)
+            try:
+                chunk = await fetcher.get_chunk(chunk_size, chunk_from)
+            except (DuniterError, ClientError, TimeoutError, ValueError) as error:
+                logging.warning(
+                    "{}: {}. Reassigning the chunk from block {}".format(
+                        fetcher.client.endpoint.inline(), error, chunk_from
+                    )
+                )
+                if fetcher in self.healthy:
+                    self.healthy.remove(fetcher)
+                continue
+            await self.cross_check(fetcher, chunk)
+            return chunk
+
+    async def cross_check(self, fetcher, chunk):
+        number = min(chunk[-1]["number"], self.last_stable_number)
+        if number < chunk[0]["number"]:
+            return
+        other = self.pick([fetcher], advance=False)
+        if other is None:
+            return
+        await other.rate_limiter.acquire()
+        try:
+            block = await other.client(bma.blockchain.block, number)
+        except (DuniterError, ClientError, TimeoutError) as error:
+            logging.warning("Block {} cross-check skipped: {}".format(number, error))
+            return
+        if block["hash"] != chunk[number - chunk[0]["number"]]["hash"]:
+            raise ValueError(
+                "Block {} hash differs between nodes {} and {}".format(
+                    number,
+                    fetcher.client.endpoint.inline(),
+                    other.client.endpoint.inline(),
+                )
+            )
+
+
+def verification_executor(jobs):
+    """Processes pool of the jobs. A single job runs within a thread,
+    so that the event loop keeps downloading the next chunks meanwhile"""
+    return ProcessPoolExecutor(jobs) if jobs > 1 else ThreadPoolExecutor(1)
+
+
+async def verify_chunk(executor, jobs, chunk, chain=False, full_parse=False):
+    """Split the chunk into one slice per job and verify the slices
+    in the processes pool. Returns the slices’ reports in blocks order.
+    Without executor, the chunk is verified in the current process"""
+    blocks = [(block["raw"], block["signature"], block["hash"]) for block in chunk]
+    if executor is None or not blocks:
+        return [verify_signed_raws(blocks, chain, full_parse)]
+    slice_size = -(-len(blocks) // jobs)
+    loop = get_event_loop()
+    return await gather(
+        *[
+            loop.run_in_executor(
+                executor,
+                verify_signed_raws,
+                blocks[i : i + slice_size],
+                chain,
+                full_parse,
+            )
+            for i in range(0, len(blocks), slice_size)
+        ]
+    )
+
+
+def verify_signed_raws(blocks, chain=False, full_parse=False):
+    """Verify the (raw, signature, hash) blocks.
+    Unless the chain is checked or a full parsing is requested, the signature
+    is checked on the raw, and the block is only parsed when this check fails.
+    Runs within the processes pool: returns the slice report"""
+    report = {
+        "invalid_blocks_signatures": list(),
+        "first_number": None,
+        "previous_hash": None,
+        "last_hash": None,
+        "wrong_hashes": list(),
+        "chain_breaks": list(),
+    }
+    keys = dict()
+    for raw, signature, hash in blocks:
+        if not chain and not full_parse and verify_raw_signature(keys, raw, signature):
+            continue
+        block = Block.from_signed_raw(raw + signature + "\n")
+        verify_block_signature(report["invalid_blocks_signatures"], block)
+        if chain:
+            verify_block_hash(report, block, hash)
+    return report
+
+
+def verify_raw_signature(keys, raw, signature):
+    """
+    Fast path checking the signature on the raw’s InnerHash and Nonce lines,
+    without parsing the block. `keys` caches the issuers’ verifying keys.
+    Returns False when the signature is wrong or the raw is unexpected
+    """
+    signed_from = raw.rfind("InnerHash: ")
+    issuer_from = raw.find("\nIssuer: ") + len("\nIssuer: ")
+    issuer_to = raw.find("\n", issuer_from)
+    if signed_from == -1 or issuer_from < len("\nIssuer: ") or issuer_to == -1:
+        return False
+    signed = raw[signed_from:]
+    if not RAW_SIGNED_TAIL.fullmatch(signed):
+        return False
+    issuer = raw[issuer_from:issuer_to]
     try:
-        return await client(bma.blockchain.blocks, chunk_size, chunk_from)
-    except ServerDisconnectedError:
-        logging.info("Reach BMA anti-spam protection. Waiting two seconds")
-        await sleep(2)
-        return await client(bma.blockchain.blocks, chunk_size, chunk_from)
-    except DuniterError as error:
-        logging.error(error)
+        key = keys.get(issuer) or keys.setdefault(issuer, VerifyingKey(issuer))
+        key.verify(b64decode(signature) + signed.encode("ascii"))
+    except ValueError:
+        return False
+    return True
+
+
+def verify_block_hash(report, block, hash):
+    """Check the block hash, the InnerHash against the block content,
+    and the link to the previous block of the slice.
+    The link of the first block is kept to be checked by `merge_report()`"""
+    computed_hash = block.proof_of_work()
+    if computed_hash != hash or block.computed_inner_hash() != block.inner_hash:
+        report["wrong_hashes"].append(block.number)
+    if report["last_hash"] is None:
+        report["first_number"] = block.number
+        report["previous_hash"] = block.prev_hash
+    elif block.prev_hash != report["last_hash"]:
+        report["chain_breaks"].append(block.number)
+    report["last_hash"] = computed_hash
+
+
+def merge_report(checkpoint, report):
+    """Merge a slice report into the checkpoint, in blocks order.
+    Only the last block hash is carried to check the link between slices"""
+    checkpoint["invalid_blocks_signatures"].extend(report["invalid_blocks_signatures"])
+    if report["last_hash"] is None:
+        return
+    checkpoint["wrong_hashes"].extend(report["wrong_hashes"])
+    if (
+        checkpoint["last_hash"] is not None
+        and report["previous_hash"] != checkpoint["last_hash"]
+    ):
+        checkpoint["chain_breaks"].append(report["first_number"])
+    checkpoint["chain_breaks"].extend(report["chain_breaks"])
+    checkpoint["last_hash"] = report["last_hash"]
 
 
 def verify_block_signature(invalid_blocks_signatures, block):
@@ -113,3 +605,40 @@ def display_result(from_block, to_block, invalid_blocks_signatures):
     else:
         result += "no blocks with a wrong signature."
     print(result)
+
+
+def display_chunk_record(checkpoint, lengths, chunk, duration):
+    """Print the JSON record of a verified chunk: the blocks reported
+    in the checkpoint since their `lengths` before the chunk verification"""
+    record = {
+        "type": "chunk",
+        "from_block": chunk[0]["number"],
+        "to_block": chunk[-1]["number"],
+        "duration": round(duration, 3),
+        "blocks_per_second": round(len(chunk) / duration, 1) if duration else None,
+    }
+    for key in REPORTED_BLOCKS:
+        if key == "invalid_blocks_signatures" or checkpoint["chain"]:
+            record[key] = checkpoint[key][lengths[key] :]
+    print(json.dumps(record), flush=True)
+
+
+def display_summary_record(from_block, to_block, checkpoint):
+    """Print the final JSON record, counting the reported blocks"""
+    record = {"type": "summary", "from_block": from_block, "to_block": to_block}
+    for key in REPORTED_BLOCKS:
+        if key == "invalid_blocks_signatures" or checkpoint["chain"]:
+            record[key] = len(checkpoint[key])
+    print(json.dumps(record), flush=True)
+
+
+def display_chain_result(from_block, to_block, wrong_hashes, chain_breaks):
+    result = "Within {0}-{1} range, ".format(from_block, to_block)
+    if wrong_hashes or chain_breaks:
+        result += "blocks with a wrong hash: "
+        result += " ".join(str(n) for n in wrong_hashes) or "none"
+        result += ", blocks not linked to the previous one: "
+        result += " ".join(str(n) for n in chain_breaks) or "none"
+    else:
+        result += "the blocks’ hash chain is intact."
+    print(result)
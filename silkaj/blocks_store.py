@@ -0,0 +1,104 @@
+"""
+Copyright  2016-2021 Maël Azimi <m.a@moul.re>
+
+Silkaj is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Silkaj is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import logging
+import sqlite3
+from duniterpy.api.bma import blockchain
+from duniterpy.api.errors import DuniterError
+
+from silkaj.tools import get_cache_dir
+from silkaj.constants import FORK_WINDOW_SIZE
+
+
+class BlocksStore(object):
+    """
+    Local archive of the blocks, one SQLite database per currency.
+    Only blocks out of the fork window are stored,
+    so that they can not be replaced by a fork resolution.
+    """
+
+    def __init__(self, currency, head_number, path=None):
+        if path is None:
+            path = get_cache_dir() / "blocks_{}.sqlite".format(currency)
+        self.last_stable_number = head_number - FORK_WINDOW_SIZE
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS blocks \
+(number INTEGER PRIMARY KEY, block TEXT NOT NULL)"
+        )
+
+    def get_blocks(self, count, start):
+        """
+        Returns the stored blocks from `start`, `count` blocks at most.
+        Stops at the first missing block, so that returned blocks are contiguous
+        """
+        blocks = list()
+        rows = self.connection.execute(
+            "SELECT number, block FROM blocks WHERE number BETWEEN ? AND ? \
+ORDER BY number",
+            (start, start + count - 1),
+        )
+        for number, block in rows:
+            if number != start + len(blocks):
+                break
+            blocks.append(json.loads(block))
+        return blocks
+
+    def add_blocks(self, blocks):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO blocks (number, block) VALUES (?, ?)",
+                [
+                    (block["number"], json.dumps(block))
+                    for block in blocks
+                    if block["number"] <= self.last_stable_number
+                ],
+            )
+
+    def tip(self):
+        """Returns the highest stored block, None when empty"""
+        row = self.connection.execute(
+            "SELECT block FROM blocks ORDER BY number DESC LIMIT 1"
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def check_tip(self, client):
+        """
+        Empties the store when its highest block is not the node’s one:
+        the currency restarted with the same name.
+        Returns whether the stored blocks were kept
+        """
+        tip = self.tip()
+        if tip is None:
+            return True
+        try:
+            block = await client(blockchain.block, tip["number"])
+        except DuniterError:
+            block = None
+        if block is not None and block["hash"] == tip["hash"]:
+            return True
+        logging.warning(
+            "Stored block {} differs from the node’s one, ".format(tip["number"])
+            + "discarding the stored blocks"
+        )
+        with self.connection:
+            self.connection.execute("DELETE FROM blocks")
+        return False
+
+    def close(self):
+        self.connection.close()
@@ -91,7 +91,7 @@ async def send_certification(ctx, uid_pubkey_to_certify):
 
 async def pre_checks(client, issuer_pubkey, pubkey_to_certify):
     # Check whether current user is member
-    issuer = await wot.is_member(issuer_pubkey)
+    issuer = await wot.is_member(issuer_pubkey, cached=False)
     if not issuer:
         message_exit("Current identity is not member.")
 
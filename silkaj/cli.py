@@ -32,7 +32,7 @@ from silkaj.commands import (
     list_blocks,
 )
 
-# from silkaj.net import network_info
+from silkaj.net import network_info, consensus_info
 from silkaj.wot import received_sent_certifications, id_pubkey_correspondence
 from silkaj.auth import generate_auth_file
 from silkaj.license import license_command
@@ -143,7 +143,8 @@ cli.add_command(id_pubkey_correspondence)
 cli.add_command(currency_info)
 cli.add_command(license_command)
 cli.add_command(send_membership)
-# cli.add_command(network_info)
+cli.add_command(network_info)
+cli.add_command(consensus_info)
 cli.add_command(send_transaction)
 cli.add_command(verify_blocks_signatures)
 cli.add_command(received_sent_certifications)
@@ -23,7 +23,6 @@ from operator import itemgetter
 from asyncio import sleep
 import aiohttp
 from _socket import gaierror
-import jsonschema
 
 from duniterpy.api import bma
 
@@ -34,7 +33,9 @@ from silkaj.network_tools import (
     EndPoint,
     ClientInstance,
 )
-from silkaj.blockchain_tools import HeadBlock
+from silkaj.blockchain_tools import HeadBlock, head_watcher
+from silkaj.blocks import get_blocks, ChunkFetcher
+from silkaj.blocks_store import BlocksStore
 from silkaj.tools import CurrencySymbol
 from silkaj.tui import convert_time
 from silkaj.constants import ASYNC_SLEEP
@@ -47,7 +48,7 @@ async def currency_info():
     ep = EndPoint().ep
     print(
         "Connected to node:",
-        ep[best_endpoint_address(ep, False)],
+        ep[await best_endpoint_address(ep, False)],
         ep["port"],
         "\nCurrent block number:",
         head_block["number"],
@@ -95,21 +96,16 @@ def power(nbr, pow=0):
 @coroutine
 async def difficulties():
     client = ClientInstance().client
-    try:
-        ws = await client(bma.ws.block)
-        while True:
-            current = await ws.receive_json()
-            jsonschema.validate(current, bma.ws.WS_BLOCK_SCHEMA)
+    head_watcher.start()
+    current = await head_watcher.current()
+    while True:
+        try:
             diffi = await client(bma.blockchain.difficulties)
+        except (aiohttp.ClientError, gaierror, TimeoutError) as e:
+            print("{0} : {1}".format(type(e).__name__, str(e)))
+        else:
             display_diffi(current, diffi)
-        await client.close()
-
-    except (aiohttp.WSServerHandshakeError, ValueError) as e:
-        print("Websocket block {0} : {1}".format(type(e).__name__, str(e)))
-    except (aiohttp.ClientError, gaierror, TimeoutError) as e:
-        print("{0} : {1}".format(str(e), BMAS_ENDPOINT))
-    except jsonschema.ValidationError as e:
-        print("{:}:{:}".format(str(e.__class__.__name__), str(e)))
+        current = await head_watcher.new_head(current)
 
 
 def display_diffi(current, diffi):
@@ -157,7 +153,14 @@ async def list_blocks(number, detailed):
     if number == 0:
         number = head_block["issuersFrame"]
     client = ClientInstance().client
-    blocks = await client(bma.blockchain.blocks, number, current_nbr - number + 1)
+    store = BlocksStore(head_block["currency"], current_nbr)
+    try:
+        await store.check_tip(client)
+        blocks = await get_blocks(
+            ChunkFetcher(client), store, number, current_nbr - number + 1
+        )
+    finally:
+        store.close()
     issuers = list()
     issuers_dict = dict()
     for block in blocks:
@@ -237,14 +240,14 @@ async def argos_info():
     print(currency_symbol, "|")
     print("---")
     ep = EndPoint().ep
-    endpoint_address = ep[best_endpoint_address(ep, False)]
+    endpoint_address = ep[await best_endpoint_address(ep, False)]
     if ep["port"] == "443":
         href = "href=https://%s/" % (endpoint_address)
     else:
         href = "href=http://%s:%s/" % (endpoint_address, ep["port"])
     print(
         "Connected to node:",
-        ep[best_endpoint_address(ep, False)],
+        endpoint_address,
         ep["port"],
         "|",
         href,
@@ -21,10 +21,41 @@ GTEST_SYMBOL = "ĞTest"
 G1_DEFAULT_ENDPOINT = "g1.duniter.org", "443"
 G1_TEST_DEFAULT_ENDPOINT = "g1-test.duniter.org", "443"
 CONNECTION_TIMEOUT = 10
+PROBE_CONCURRENCY = 50
+HAPPY_EYEBALLS_DELAY = 0.25
+DISCOVER_MAX_DEPTH = 5
+DISCOVER_WORKERS = 10
+DISCOVER_TIME_BUDGET = 60
+LEAVES_CONCURRENCY = 5
+PEERS_CACHE_TTL = 3600
+PEERS_HEAD_TOLERANCE = 2
+PEERS_REFRESH_GRACE = 3
+CLIENT_POOL_SIZE = 3
+CIRCUIT_BREAKER_FAILURES = 2
+CIRCUIT_BREAKER_DELAY = 30
+LATENCY_SMOOTHING = 0.3
+POOL_CONNECTIONS = 100
+POOL_CONNECTIONS_PER_HOST = 4
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+PARAMS_CACHE_TTL = 604800
+IDENTITY_CACHE_SIZE = 1024
+IDENTITY_CACHE_TTL = 86400
+IDENTITY_NEGATIVE_TTL = 3600
+HEAD_BLOCK_TTL = 10
+UD_VALUE_TTL = 3600
+HEAD_POLL_INTERVAL = 60
+HEAD_RECONNECT_DELAY = 1
+HEAD_RECONNECT_MAX_DELAY = 300
+HEAD_WS_TIMEOUT = 1200
 ASYNC_SLEEP = 0.15
 SUCCESS_EXIT_STATUS = 0
 FAILURE_EXIT_STATUS = 1
 BMA_MAX_BLOCKS_CHUNK_SIZE = 5000
+BMA_REQUESTS_RATE = 5
+BMA_REQUESTS_BURST = 10
+FORK_WINDOW_SIZE = 100
+CACHE_DIR_NAME = "silkaj"
 PUBKEY_MIN_LENGTH = 43
 PUBKEY_MAX_LENGTH = 44
 PUBKEY_PATTERN = f"[1-9A-HJ-NP-Za-km-z]{{{PUBKEY_MIN_LENGTH},{PUBKEY_MAX_LENGTH}}}"
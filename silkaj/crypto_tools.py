@@ -17,6 +17,7 @@ along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 
 import re
 import hashlib
+from functools import lru_cache
 
 import base58
 
@@ -25,6 +26,7 @@ from silkaj.tools import message_exit
 
 PUBKEY_DELIMITED_PATTERN = "^{0}$".format(PUBKEY_PATTERN)
 CHECKSUM_SIZE = 3
+CHECKSUMS_CACHE_SIZE = 4096
 CHECKSUM_PATTERN = f"[1-9A-HJ-NP-Za-km-z]{{{CHECKSUM_SIZE}}}"
 PUBKEY_CHECKSUM_PATTERN = "^{0}:{1}$".format(PUBKEY_PATTERN, CHECKSUM_PATTERN)
 
@@ -75,10 +77,20 @@ def validate_checksum(pubkey_checksum):
     )
 
 
+@lru_cache(maxsize=CHECKSUMS_CACHE_SIZE)
 def gen_checksum(pubkey):
     """
     Returns the checksum of the input pubkey (encoded in b58)
+    Memoized: tables display the same pubkeys on many rows
     """
     pubkey_byte = base58.b58decode(pubkey)
     hash = hashlib.sha256(hashlib.sha256(pubkey_byte).digest()).digest()
     return base58.b58encode(hash)[:3].decode("utf-8")
+
+
+def gen_checksums(pubkeys):
+    """
+    Returns the checksums of the input pubkeys by pubkey,
+    computing each distinct pubkey’s checksum once
+    """
+    return {pubkey: gen_checksum(pubkey) for pubkey in set(pubkeys)}
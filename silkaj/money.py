@@ -15,12 +15,17 @@ You should have received a copy of the GNU Affero General Public License
 along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 """
 
+import json
+from os import replace
+from time import time
 from click import command, argument, pass_context, echo
 from tabulate import tabulate
 
 from silkaj.network_tools import ClientInstance
-from silkaj.blockchain_tools import HeadBlock
-from silkaj.tools import CurrencySymbol, message_exit, coroutine
+from silkaj.blockchain_tools import HeadBlock, BlockchainParams, params_source
+from silkaj.tools import CurrencySymbol, message_exit, coroutine, get_cache_dir
+from silkaj.async_cache import AsyncCache
+from silkaj.constants import UD_VALUE_TTL
 from silkaj.auth import auth_method, has_auth_method
 
 # had to import wot to prevent loop dependency. No use here.
@@ -35,6 +40,8 @@ from silkaj.tui import display_amount, display_pubkey_and_checksum
 from duniterpy.api.bma import tx, blockchain
 from duniterpy.documents.transaction import InputSource
 
+UD_CACHE_FILENAME = "ud_value.json"
+
 
 @command("balance", help="Get wallet balance")
 @argument("pubkeys", nargs=-1)
@@ -191,22 +198,71 @@ async def get_sources(pubkey):
 
 
 class UDValue(object):
-    __instance = None
-
-    def __new__(cls):
-        if UDValue.__instance is None:
-            UDValue.__instance = object.__new__(cls)
-        return UDValue.__instance
+    cache = AsyncCache(UD_VALUE_TTL)
 
-    def __init__(self):
-        self.ud_value = self.get_ud_value()
+    @property
+    def ud_value(self):
+        return UDValue.cache.get("ud_value", self.get_ud_value)
 
     async def get_ud_value(self):
+        """
+        Returns the cached UD value, with no request until the next UD time.
+        Then, the head block tells whether the median time reached it
+        """
+        cache = UDCache()
+        source = params_source()
+        ud = cache.ud.get(source)
+        if ud is not None and time() < ud["next_time"]:
+            return ud["value"]
+        if ud is not None:
+            head = await HeadBlock().head_block
+            if head["medianTime"] < ud["next_time"]:
+                return ud["value"]
         client = ClientInstance().client
         blockswithud = await client(blockchain.ud)
         NBlastUDblock = blockswithud["result"]["blocks"][-1]
         lastUDblock = await client(blockchain.block, NBlastUDblock)
-        return lastUDblock["dividend"] * 10 ** lastUDblock["unitbase"]
+        ud_value = lastUDblock["dividend"] * 10 ** lastUDblock["unitbase"]
+        cache.ud[source] = {
+            "number": lastUDblock["number"],
+            "value": ud_value,
+            "next_time": next_ud_time(lastUDblock, await BlockchainParams().params),
+        }
+        cache.save()
+        return ud_value
+
+
+def next_ud_time(ud_block, params):
+    """The median time of the next UD, created every `dt` from `udTime0`"""
+    periods = (ud_block["medianTime"] - params["udTime0"]) // params["dt"] + 1
+    return params["udTime0"] + periods * params["dt"]
+
+
+class UDCache(object):
+    """
+    Last UD block number and value by source, stored in the cache directory.
+    Kept in memory only when the cache directory can not be written
+    """
+
+    def __init__(self):
+        self.path = None
+        try:
+            self.path = get_cache_dir() / UD_CACHE_FILENAME
+            with self.path.open() as cache_file:
+                self.ud = json.load(cache_file)
+        except (OSError, ValueError):
+            self.ud = dict()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            with tmp_path.open("w") as cache_file:
+                json.dump(self.ud, cache_file)
+            replace(str(tmp_path), str(self.path))
+        except OSError:
+            self.path = None
 
 
 def amount_in_current_base(source):
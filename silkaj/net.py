@@ -15,36 +15,34 @@ You should have received a copy of the GNU Affero General Public License
 along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 """
 
-"""
-from click import command, option, get_terminal_size
+from click import command, option, get_terminal_size, clear, IntRange
 from datetime import datetime
-from os import system
 from collections import OrderedDict
 from tabulate import tabulate
-from asyncio import sleep
+from asyncio import sleep, gather, wait_for, Semaphore
 
-from duniterpy.api.client import Client
 from duniterpy.api import bma
 
 from silkaj.tools import coroutine
-from silkaj.wot import identity_of
 from silkaj.network_tools import (
     discover_peers,
-    best_endpoint_address,
+    generate_duniterpy_endpoint_format,
     ClientInstance,
+    EndPoint,
+    PooledClient,
 )
 from silkaj.tools import message_exit
 from silkaj.tui import convert_time
-from silkaj.constants import ASYNC_SLEEP
+from silkaj.constants import CONNECTION_TIMEOUT, DISCOVER_WORKERS, FORK_WINDOW_SIZE
 
 
-def get_network_sort_key(endpoint):
+def get_network_sort_key(endpoint, sort_keys):
     t = list()
-    for akey in network_sort_keys:
+    for akey in sort_keys:
         if akey == "diffi" or akey == "block" or akey == "port":
-            t.append(int(endpoint[akey]) if akey in endpoint else 0)
+            t.append(int(endpoint[akey]) if endpoint.get(akey) is not None else 0)
         else:
-            t.append(str(endpoint[akey]) if akey in endpoint else "")
+            t.append(str(endpoint[akey]) if endpoint.get(akey) is not None else "")
     return tuple(t)
 
 
@@ -59,10 +57,15 @@ def get_network_sort_key(endpoint):
     show_default=True,
     help="Sort column names comma-separated",
 )
+@option(
+    "--refresh",
+    "-r",
+    type=IntRange(1),
+    help="Refresh the view every REFRESH seconds, only re-polling the peers \
+whose head changed",
+)
 @coroutine
-async def network_info(discover, sort):
-    global network_sort_keys
-    network_sort_keys = sort.split(",")
+async def network_info(discover, sort, refresh):
     width = get_terminal_size()[0]
     if width < 146:
         message_exit(
@@ -72,64 +75,99 @@ async def network_info(discover, sort):
     # and make sure fields are always ordered the same
     infos = [
         OrderedDict(
-            (i, p.get(i, None)) for i in ("domain", "port", "ip4", "ip6", "pubkey")
+            (i, p.get(i, None))
+            for i in ("domain", "port", "ip4", "ip6", "pubkey", "api", "path")
         )
         for p in await discover_peers(discover)
     ]
     client = ClientInstance().client
-    diffi = await client(bma.blockchain.difficulties)
-    members = 0
-    print("Getting informations about nodes:")
-    for i, info in enumerate(infos):
-        ep = info
-        api = "BASIC_MERKLED_API " if ep["port"] != "443" else "BMAS "
-        api += ep.get("domain") + " " if ep["domain"] else ""
-        api += ep.get("ip4") + " " if ep["ip4"] else ""
-        api += ep.get("ip6") + " " if ep["ip6"] else ""
-        api += ep.get("port")
-        print("{0:.0f}%".format(i / len(infos) * 100, 1), end=" ")
-        best_ep = best_endpoint_address(info, False)
-        print(best_ep if best_ep is None else info[best_ep], end=" ")
-        print(info["port"])
-        await sleep(ASYNC_SLEEP)
+    diffi, members, heads = await gather(
+        client(bma.blockchain.difficulties),
+        client(bma.wot.members),
+        get_ws2p_heads(client),
+    )
+    levels = {level["uid"]: level["level"] for level in diffi["levels"]}
+    uids = {member["pubkey"]: member["uid"] for member in members["results"]}
+    for info in infos:
+        info["uid"] = uids.get(info["pubkey"])
+        info["member"] = "yes" if info["uid"] is not None else "no"
+        info["diffi"] = levels.get(info["uid"])
+    print("Getting informations about nodes")
+    await poll_peers(infos)
+    display_network(infos, sort.split(","), width)
+    while refresh:
+        await sleep(refresh)
+        new_heads = await get_ws2p_heads(client)
+        await poll_peers(changed_peers(infos, heads, new_heads))
+        heads = new_heads
+        clear()
+        display_network(infos, sort.split(","), width)
+    await client.close()
+
+
+async def get_ws2p_heads(client):
+    """
+    Returns the heads’ blockstamps of the WS2P peers known by the node,
+    by pubkey. None if the node does not give them
+    """
+    try:
+        heads = await client(bma.network.ws2p_heads)
+    except Exception:
+        return None
+    blockstamps = dict()
+    for head in heads["heads"]:
+        # WS2POCAIC:HEAD:2:pubkey:blockstamp:…
+        fields = head["messageV2"].split(":")
+        if len(fields) > 4:
+            blockstamps.setdefault(fields[3], set()).add(fields[4])
+    return blockstamps
+
+
+def changed_peers(infos, heads, new_heads):
+    """The peers whose heads changed, all of them without the heads"""
+    if heads is None or new_heads is None:
+        return infos
+    return [
+        info
+        for info in infos
+        if heads.get(info["pubkey"]) != new_heads.get(info["pubkey"])
+    ]
+
+
+async def poll_peers(infos):
+    """Query the peers concurrently, at most DISCOVER_WORKERS at a time"""
+    semaphore = Semaphore(DISCOVER_WORKERS)
+    await gather(*[poll_peer(info, semaphore) for info in infos])
+
+
+async def poll_peer(info, semaphore):
+    """Set the peer’s head block and version, None when it fails to answer"""
+    ep = {key: value for key, value in info.items() if key in ENDPOINT_KEYS and value}
+    async with semaphore:
+        sub_client = PooledClient(generate_duniterpy_endpoint_format(ep))
         try:
-            info["uid"] = await identity_of(info["pubkey"])
-            info["uid"] = info["uid"]["uid"]
-            info["member"] = "yes"
-            members += 1
-        except:
-            info["uid"] = None
-            info["member"] = "no"
-        info["pubkey"] = info["pubkey"][:5] + "…"
-        for d in diffi["levels"]:
-            if info.get("uid") is not None:
-                if info["uid"] == d["uid"]:
-                    info["diffi"] = d["level"]
-                if len(info["uid"]) > 10:
-                    info["uid"] = info["uid"][:9] + "…"
-        sub_client = Client(api)
-        current_blk = await sub_client(bma.blockchain.current)
-        if current_blk is not None:
-            info["gen_time"] = convert_time(current_blk["time"], "hour")
-            if width > 171:
-                info["mediantime"] = convert_time(current_blk["medianTime"], "hour")
-            if width > 185:
-                info["difftime"] = convert_time(
-                    current_blk["time"] - current_blk["medianTime"], "hour"
-                )
-            info["block"] = current_blk["number"]
-            info["hash"] = current_blk["hash"][:10] + "…"
-            summary = await sub_client(bma.node.summary)
-            info["version"] = summary["duniter"]["version"]
+            current_blk, summary = await gather(
+                wait_for(sub_client(bma.blockchain.current), CONNECTION_TIMEOUT),
+                wait_for(sub_client(bma.node.summary), CONNECTION_TIMEOUT),
+            )
+        except Exception:
+            current_blk, summary = None, None
         await sub_client.close()
-        if info.get("domain") is not None and len(info["domain"]) > 20:
-            info["domain"] = "…" + info["domain"][-20:]
-        if info.get("ip6") is not None:
-            if width < 156:
-                info.pop("ip6")
-            else:
-                info["ip6"] = info["ip6"][:8] + "…"
-    await client.close()
+    for key in ("block", "hash", "time", "medianTime", "version"):
+        info[key] = None
+    if current_blk is not None:
+        info["block"] = current_blk["number"]
+        info["hash"] = current_blk["hash"]
+        info["time"] = current_blk["time"]
+        info["medianTime"] = current_blk["medianTime"]
+        info["version"] = summary["duniter"]["version"]
+
+
+ENDPOINT_KEYS = ("api", "domain", "port", "ip4", "ip6", "path")
+
+
+def display_network(infos, sort_keys, width):
+    members = sum(info["member"] == "yes" for info in infos)
     print(
         len(infos),
         "peers ups, with",
@@ -139,7 +177,200 @@ async def network_info(discover, sort):
         "non-members at",
         datetime.now().strftime("%H:%M:%S"),
     )
-    infos = sorted(infos, key=get_network_sort_key)
-    print(tabulate(infos, headers="keys", tablefmt="orgtbl", stralign="center"))
+    infos = sorted(infos, key=lambda info: get_network_sort_key(info, sort_keys))
+    rows = [network_row(info, width) for info in infos]
+    print(tabulate(rows, headers="keys", tablefmt="orgtbl", stralign="center"))
 
-"""
+
+def network_row(info, width):
+    """Shorten the peer’s fields to fit the terminal width"""
+    row = OrderedDict(info)
+    row["pubkey"] = info["pubkey"][:5] + "…"
+    if info["uid"] is not None and len(info["uid"]) > 10:
+        row["uid"] = info["uid"][:9] + "…"
+    if info["domain"] is not None and len(info["domain"]) > 20:
+        row["domain"] = "…" + info["domain"][-20:]
+    if info["ip6"] is not None:
+        if width < 156:
+            row.pop("ip6")
+        else:
+            row["ip6"] = info["ip6"][:8] + "…"
+    for key in ("api", "path", "time", "medianTime"):
+        row.pop(key)
+    if info["block"] is not None:
+        row["hash"] = info["hash"][:10] + "…"
+        row["gen_time"] = convert_time(info["time"], "hour")
+        if width > 171:
+            row["mediantime"] = convert_time(info["medianTime"], "hour")
+        if width > 185:
+            row["difftime"] = convert_time(info["time"] - info["medianTime"], "hour")
+    return row
+
+
+@command(
+    "consensus",
+    help="Check whether the node is on the network’s majority branch, \
+and find the blocks where the other branches forked",
+)
+@option(
+    "--discover", "-d", is_flag=True, help="Discover the network (could take a while)"
+)
+@coroutine
+async def consensus_info(discover):
+    endpoints = await discover_peers(discover)
+    # The configured node itself, the failover client could answer from another one
+    client = PooledClient(EndPoint().BMA_ENDPOINT)
+    main_head = await client(bma.blockchain.current)
+    groups = group_heads(await get_peers_heads(endpoints))
+    print("Heads of the {} reachable peers:".format(len(endpoints)))
+    print(
+        tabulate(
+            [
+                OrderedDict(
+                    (("block", number), ("hash", hash[:10] + "…"), ("peers", len(eps)))
+                )
+                for (number, hash), eps in groups.items()
+            ],
+            headers="keys",
+            tablefmt="orgtbl",
+        )
+    )
+    branches = await find_branches(client, main_head, groups)
+    for branch in branches[1:]:
+        try:
+            branch["fork_point"] = await fork_point(
+                branches[0]["client"],
+                branch["client"],
+                min(branches[0]["head"]["number"], branch["head"]["number"]),
+            )
+        except Exception:
+            branch["fork_point"] = None
+    display_consensus(branches)
+    await client.close()
+
+
+async def get_peers_heads(endpoints):
+    """Returns the peers’ (endpoint, head block), None for the failing ones"""
+    semaphore = Semaphore(DISCOVER_WORKERS)
+    return list(
+        zip(endpoints, await gather(*[get_head(ep, semaphore) for ep in endpoints]))
+    )
+
+
+async def get_head(ep, semaphore):
+    async with semaphore:
+        sub_client = PooledClient(generate_duniterpy_endpoint_format(ep))
+        try:
+            return await wait_for(
+                sub_client(bma.blockchain.current), CONNECTION_TIMEOUT
+            )
+        except Exception:
+            return None
+        finally:
+            await sub_client.close()
+
+
+def group_heads(heads):
+    """Group the peers by (number, hash) of their head, the biggest group first"""
+    groups = OrderedDict()
+    for ep, head in heads:
+        if head is not None:
+            groups.setdefault((head["number"], head["hash"]), list()).append(ep)
+    return OrderedDict(
+        sorted(groups.items(), key=lambda group: (-len(group[1]), -group[0][0]))
+    )
+
+
+async def find_branches(client, main_head, groups):
+    """
+    Sort the heads groups into branches, the main node’s one first.
+    A group belongs to a branch when their hashes are the same at their common
+    height: the lowest head being behind the other one on the same branch
+    """
+    branches = [{"client": client, "head": main_head, "peers": list()}]
+    for (number, hash), eps in groups.items():
+        head = {"number": number, "hash": hash}
+        peer_client = PooledClient(generate_duniterpy_endpoint_format(eps[0]))
+        try:
+            for branch in branches:
+                if await same_branch(
+                    branch["client"], branch["head"], peer_client, head
+                ):
+                    branch["peers"].extend(eps)
+                    break
+            else:
+                branches.append({"client": peer_client, "head": head, "peers": eps})
+        except Exception as e:
+            print("Peers at head {}-{} skipped: {}".format(number, hash[:10], e))
+    return branches
+
+
+async def same_branch(client_a, head_a, client_b, head_b):
+    height = min(head_a["number"], head_b["number"])
+    return await block_hash(client_a, head_a, height) == await block_hash(
+        client_b, head_b, height
+    )
+
+
+async def block_hash(client, head, number):
+    if number == head["number"]:
+        return head["hash"]
+    return (await wait_for(client(bma.blockchain.block, number), CONNECTION_TIMEOUT))[
+        "hash"
+    ]
+
+
+async def fork_point(client_a, client_b, height):
+    """
+    Returns the first block which differs between the two nodes’ branches,
+    known to differ at `height`. Bisects from FORK_WINDOW_SIZE blocks below,
+    or from the genesis block if they differ there too:
+    O(log n) blocks requests instead of a scan
+    """
+
+    async def same(number):
+        hashes = await gather(
+            wait_for(client_a(bma.blockchain.block, number), CONNECTION_TIMEOUT),
+            wait_for(client_b(bma.blockchain.block, number), CONNECTION_TIMEOUT),
+        )
+        return hashes[0]["hash"] == hashes[1]["hash"]
+
+    low, high = max(height - FORK_WINDOW_SIZE, 0), height
+    if not await same(low):
+        if low == 0:
+            return 0
+        low = 0
+        if not await same(low):
+            return 0
+    # The blocks are the same at `low` and differ at `high`
+    while high - low > 1:
+        middle = (low + high) // 2
+        if await same(middle):
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+def display_consensus(branches):
+    majority = max(branches, key=lambda branch: len(branch["peers"]))
+    for i, branch in enumerate(branches):
+        result = "Branch {}: head {}-{}…, {} peers".format(
+            i + 1,
+            branch["head"]["number"],
+            branch["head"]["hash"][:10],
+            len(branch["peers"]),
+        )
+        if i == 0:
+            result += ", with the node"
+        elif branch["fork_point"] is None:
+            result += ", fork point unknown"
+        else:
+            result += ", forked at block {}".format(branch["fork_point"])
+        print(result)
+    if len(branches) == 1:
+        print("No fork: the node and its peers are on the same branch.")
+    elif majority is branches[0]:
+        print("The node is on the majority branch.")
+    else:
+        print("The node is not on the majority branch!")
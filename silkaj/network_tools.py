@@ -17,103 +17,450 @@ along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import unicode_literals
 import re
-import socket
+import json
 import logging
+from os import replace
 from sys import exit, stderr
-from asyncio import sleep
-from duniterpy.api.client import Client
-from duniterpy.api.bma import network
+from time import monotonic, time
+from functools import lru_cache
+from collections.abc import Mapping
+from asyncio import (
+    sleep,
+    wait,
+    wait_for,
+    gather,
+    ensure_future,
+    open_connection,
+    Semaphore,
+    TimeoutError,
+    CancelledError,
+    get_event_loop,
+    FIRST_COMPLETED,
+)
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.client_exceptions import ClientError
+from duniterpy.api.client import Client, RESPONSE_JSON
+from duniterpy.api.errors import DuniterError, HTTP_LIMITATION
+from duniterpy.api.bma import network, blockchain
 from duniterpy.constants import IPV4_REGEX, IPV6_REGEX
 
 from silkaj.constants import (
     G1_DEFAULT_ENDPOINT,
     G1_TEST_DEFAULT_ENDPOINT,
     CONNECTION_TIMEOUT,
-    ASYNC_SLEEP,
+    PROBE_CONCURRENCY,
+    HAPPY_EYEBALLS_DELAY,
+    DISCOVER_MAX_DEPTH,
+    DISCOVER_WORKERS,
+    DISCOVER_TIME_BUDGET,
+    LEAVES_CONCURRENCY,
+    PEERS_CACHE_TTL,
+    PEERS_HEAD_TOLERANCE,
+    PEERS_REFRESH_GRACE,
+    CLIENT_POOL_SIZE,
+    CIRCUIT_BREAKER_FAILURES,
+    CIRCUIT_BREAKER_DELAY,
+    LATENCY_SMOOTHING,
+    POOL_CONNECTIONS,
+    POOL_CONNECTIONS_PER_HOST,
+    DNS_CACHE_TTL,
+    KEEPALIVE_TIMEOUT,
     FAILURE_EXIT_STATUS,
+    BMA_REQUESTS_RATE,
+    BMA_REQUESTS_BURST,
 )
 
+LEAVES_CACHE_FILENAME = "peers_leaves.json"
+LEAVES_CACHE_SIZE = 10000
+PEERS_CACHE_FILENAME = "peers_{}.json"
+ENDPOINTS_CACHE_SIZE = 4096
+BMA_APIS = ("BMAS", "BASIC_MERKLED_API")
+ENDPOINT_APIS = BMA_APIS + ("WS2P", "WS2PTOR", "GVA")
+ADDRESS_TYPES = {0: "domain", 4: "ip4", 6: "ip6"}
+IPV4_PATTERN = re.compile(IPV4_REGEX)
+IPV6_PATTERN = re.compile(IPV6_REGEX)
+
 
 async def discover_peers(discover):
     """
     From first node, discover his known nodes.
     Remove from know nodes if nodes are down.
-    If discover option: scan all network to know all nodes.
-        display percentage discovering.
+    If discover option: crawl the network breadth-first to know all nodes.
     """
     client = ClientInstance().client
-    endpoints = await get_peers_among_leaves(client)
+    leaves_cache = LeavesCache()
+    endpoints = await reachable_endpoints(
+        unique_endpoints(await get_peers_among_leaves(client, leaves_cache))
+    )
     if discover:
         print("Discovering network")
-    for i, endpoint in enumerate(endpoints):
-        if discover:
-            print("{0:.0f}%".format(i / len(endpoints) * 100))
-        if best_endpoint_address(endpoint, False) is None:
-            endpoints.remove(endpoint)
-        elif discover:
-            endpoints = await recursive_discovering(endpoints, endpoint)
+        endpoints = await crawl_network(endpoints, leaves_cache=leaves_cache)
+    leaves_cache.save()
     return endpoints
 
 
-async def recursive_discovering(endpoints, endpoint):
+peers_refresh = {"task": None}
+
+
+def start_peers_refresh(client):
     """
-    Discover recursively new nodes.
-    If new node found add it and try to found new node from his known nodes.
+    Refreshes the stale peers cache in the background of the command,
+    from the peers known by the main node
     """
-    api = generate_duniterpy_endpoint_format(endpoint)
-    sub_client = Client(api)
-    news = await get_peers_among_leaves(sub_client)
-    await sub_client.close()
-    for new in news:
-        if best_endpoint_address(new, False) is not None and new not in endpoints:
-            endpoints.append(new)
-            await recursive_discovering(endpoints, new)
-    return endpoints
+    endpoint = EndPoint()
+    if endpoint.pinned or peers_refresh["task"] is not None:
+        return
+    if not get_event_loop().is_running() or not PeersCache(endpoint.gtest).stale():
+        return
+    peers_refresh["task"] = ensure_future(refresh_peers(client, endpoint.gtest))
+
+
+async def refresh_peers(client, gtest):
+    leaves_cache = LeavesCache()
+    try:
+        probes = dict()
+        endpoints = await reachable_endpoints(
+            unique_endpoints(await get_peers_among_leaves(client, leaves_cache)),
+            probes,
+        )
+        await refresh_peers_cache(endpoints, gtest, probes)
+    except Exception as e:
+        logging.debug("Peers cache refresh failed (%s)" % e)
+    finally:
+        # Keep the leaves fetched before a cancellation
+        leaves_cache.save()
+
+
+async def stop_peers_refresh(grace=PEERS_REFRESH_GRACE):
+    """Leaves `grace` seconds to the peers refresh to complete, then cancels it"""
+    task, peers_refresh["task"] = peers_refresh["task"], None
+    if task is None or task.done():
+        return
+    try:
+        await wait_for(task, grace)
+    except (TimeoutError, CancelledError):
+        pass
+
+
+async def crawl_network(
+    endpoints,
+    max_depth=DISCOVER_MAX_DEPTH,
+    time_budget=DISCOVER_TIME_BUDGET,
+    workers=DISCOVER_WORKERS,
+    leaves_cache=None,
+):
+    """
+    Discovers the network breadth-first from the reachable `endpoints`.
+    The nodes of a depth are queried for their peers concurrently,
+    by at most `workers` at a time. The reachable new peers form the next depth.
+    Stops after `max_depth` depths or once `time_budget` seconds are spent.
+    Returns the reachable endpoints in discovery order
+    """
+    cache = leaves_cache or LeavesCache()
+    deadline = monotonic() + time_budget
+    visited = {endpoint_key(ep) for ep in endpoints}
+    discovered, depth_endpoints = list(endpoints), list(endpoints)
+    semaphore = Semaphore(workers)
+    for depth in range(1, max_depth + 1):
+        if not depth_endpoints or monotonic() >= deadline:
+            break
+        print("Depth {}: querying {} nodes".format(depth, len(depth_endpoints)))
+        news = list()
+        for peers in await gather(
+            *[query_peers(ep, semaphore, deadline, cache) for ep in depth_endpoints]
+        ):
+            for peer in peers:
+                key = endpoint_key(peer)
+                if key not in visited:
+                    visited.add(key)
+                    news.append(peer)
+        depth_endpoints = await reachable_endpoints(news)
+        discovered.extend(depth_endpoints)
+    if leaves_cache is None:
+        cache.save()
+    return discovered
+
+
+async def query_peers(ep, semaphore, deadline, leaves_cache):
+    """Returns the peers known by the node, none if it fails before the deadline"""
+    async with semaphore:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return list()
+        client = PooledClient(generate_duniterpy_endpoint_format(ep))
+        try:
+            return await wait_for(
+                get_peers_among_leaves(client, leaves_cache), remaining
+            )
+        except Exception as e:
+            logging.debug("Peers discovery from %s failed (%s)" % (ep, e))
+            return list()
+        finally:
+            await client.close()
+
+
+def endpoint_key(ep):
+    """Identifies a node’s endpoint by its pubkey and addresses"""
+    return tuple(ep.get(key) for key in ("pubkey", "domain", "ip4", "ip6", "port"))
+
+
+def unique_endpoints(endpoints):
+    """Removes the duplicated endpoints, keeping the order"""
+    visited = set()
+    uniques = list()
+    for ep in endpoints:
+        if endpoint_key(ep) not in visited:
+            visited.add(endpoint_key(ep))
+            uniques.append(ep)
+    return uniques
+
+
+async def get_peers_among_leaves(client, leaves_cache=None):
+    """
+    Browse among leaves of peers to retrieve the other peers’ endpoints.
+    Only the leaves missing from the cache are requested, concurrently
+    and within BMA requests rate limitation.
+    Without `leaves_cache`, the leaves cache is loaded and saved
+    """
+    cache = leaves_cache or LeavesCache()
+    leaves = await client(network.peering_peers, leaves=True)
+    missing = [leaf for leaf in leaves["leaves"] if leaf not in cache.leaves]
+    semaphore, rate_limiter = Semaphore(LEAVES_CONCURRENCY), TokenBucket()
+    values = await gather(
+        *[cache_leaf(client, leaf, cache, semaphore, rate_limiter) for leaf in missing]
+    )
+    fetched = dict(zip(missing, values))
+    if leaves_cache is None and missing:
+        cache.save()
+    return parse_endpoints(
+        [fetched.get(leaf) or cache.leaves[leaf] for leaf in leaves["leaves"]]
+    )
+
+
+async def cache_leaf(client, leaf, cache, semaphore, rate_limiter):
+    """
+    Returns the peer document of a leaf, cached as soon as fetched.
+    The UP/DOWN status is the node’s view, not covered by the leaf hash
+    """
+    peer = await get_leaf(client, leaf, semaphore, rate_limiter)
+    cache.leaves[leaf] = {key: value for key, value in peer.items() if key != "status"}
+    return peer
+
+
+async def get_leaf(client, leaf, semaphore, rate_limiter):
+    """Returns the peer document of a leaf of the peers Merkle tree"""
+    async with semaphore:
+        await rate_limiter.acquire()
+        leaf_response = await client(network.peering_peers, leaf=leaf)
+    return leaf_response["leaf"]["value"]
+
+
+class LeavesCache(object):
+    """
+    Peers documents by their hash in the peers Merkle tree, stored in the cache
+    directory. A leaf hash being its document hash, a cached leaf never changes:
+    when a node’s Merkle root is unchanged, none of its leaves is requested again.
+    The peers’ status is not cached: it is the requested node’s view,
+    which changes without changing the leaf hash.
+    Kept in memory only when the cache directory can not be written
+    """
+
+    def __init__(self):
+        # silkaj.tools imports this module through silkaj.blockchain_tools
+        from silkaj.tools import get_cache_dir
+
+        self.path = None
+        try:
+            self.path = get_cache_dir() / LEAVES_CACHE_FILENAME
+            with self.path.open() as cache_file:
+                self.leaves = json.load(cache_file)
+        except (OSError, ValueError):
+            self.leaves = dict()
+
+    def save(self):
+        """Keep the most recent leaves and write the cache atomically"""
+        for leaf in list(self.leaves)[: max(len(self.leaves) - LEAVES_CACHE_SIZE, 0)]:
+            del self.leaves[leaf]
+        if self.path is None:
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            with tmp_path.open("w") as cache_file:
+                json.dump(self.leaves, cache_file)
+            replace(str(tmp_path), str(self.path))
+        except OSError:
+            self.path = None
 
 
-async def get_peers_among_leaves(client):
+class PeersCache(object):
     """
-    Browse among leaves of peers to retrieve the other peers’ endpoints
+    Peers of the G1 or the G1-Test network, stored in the cache directory
+    with their connect latency, head block number, and last success time.
+    Kept in memory only when the cache directory can not be written
     """
-    leaves = await client(network.peers, leaves=True)
-    peers = list()
-    for leaf in leaves["leaves"]:
-        await sleep(ASYNC_SLEEP + 0.05)
-        leaf_response = await client(network.peers, leaf=leaf)
-        peers.append(leaf_response["leaf"]["value"])
-    return parse_endpoints(peers)
+
+    def __init__(self, gtest=False):
+        # silkaj.tools imports this module through silkaj.blockchain_tools
+        from silkaj.tools import get_cache_dir
+
+        self.path = None
+        try:
+            self.path = get_cache_dir() / PEERS_CACHE_FILENAME.format(
+                "g1-test" if gtest else "g1"
+            )
+            with self.path.open() as cache_file:
+                cache = json.load(cache_file)
+            self.updated, self.peers = cache["updated"], cache["peers"]
+        except (OSError, ValueError, KeyError):
+            self.updated, self.peers = 0, dict()
+
+    def stale(self):
+        return time() - self.updated >= PEERS_CACHE_TTL
+
+    def record(self, ep, latency, head):
+        """Record a peer success, or its failure when `head` is None"""
+        peer = self.peers.setdefault(generate_duniterpy_endpoint_format(ep), dict())
+        peer["endpoint"] = dict(ep)
+        if head is None:
+            peer["last_failure"] = time()
+        else:
+            peer["latency"], peer["head"], peer["last_success"] = latency, head, time()
+
+    def best(self):
+        """Returns the endpoint of the fastest healthy peer, None without any"""
+        ranked = self.ranked()
+        return ranked[0]["endpoint"] if ranked else None
+
+    def ranked(self):
+        """
+        Returns the peers which succeeded within PEERS_CACHE_TTL and are
+        in sync with the highest head, from the lowest latency
+        """
+        now = time()
+        healthy = [
+            peer
+            for peer in self.peers.values()
+            if now - peer.get("last_success", 0) < PEERS_CACHE_TTL
+            and peer["last_success"] > peer.get("last_failure", 0)
+        ]
+        if not healthy:
+            return list()
+        highest = max(peer["head"] for peer in healthy)
+        in_sync = [
+            peer for peer in healthy if peer["head"] >= highest - PEERS_HEAD_TOLERANCE
+        ]
+        return sorted(in_sync, key=lambda peer: peer["latency"])
+
+    def save(self):
+        self.updated = time()
+        if self.path is None:
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            with tmp_path.open("w") as cache_file:
+                json.dump({"updated": self.updated, "peers": self.peers}, cache_file)
+            replace(str(tmp_path), str(self.path))
+        except OSError:
+            self.path = None
+
+
+async def refresh_peers_cache(endpoints, gtest=False, probes=None):
+    """
+    Probes the endpoints and requests their head block concurrently,
+    to record them into the peers cache.
+    The endpoints within `probes`, by endpoint key, are not probed again
+    """
+    cache = PeersCache(gtest)
+    probes = probes or dict()
+    unprobed = [ep for ep in endpoints if endpoint_key(ep) not in probes]
+    probes.update(zip(map(endpoint_key, unprobed), await probe_endpoints(unprobed)))
+    probes = [probes[endpoint_key(ep)] for ep in endpoints]
+    reachables = list()
+    for ep, (address, latency) in zip(endpoints, probes):
+        if address is None:
+            cache.record(ep, None, None)
+        else:
+            reachables.append((ep, latency))
+    semaphore = Semaphore(DISCOVER_WORKERS)
+    heads = await gather(*[get_head_number(ep, semaphore) for ep, _ in reachables])
+    for (ep, latency), head in zip(reachables, heads):
+        cache.record(ep, latency, head)
+    cache.save()
+    return cache
+
+
+async def get_head_number(ep, semaphore):
+    """Returns the node’s head block number, None if it fails"""
+    async with semaphore:
+        client = PooledClient(generate_duniterpy_endpoint_format(ep))
+        try:
+            return (await wait_for(client(blockchain.current), CONNECTION_TIMEOUT))[
+                "number"
+            ]
+        except Exception as e:
+            logging.debug("Head request to %s failed (%s)" % (ep, e))
+            return None
+        finally:
+            await client.close()
 
 
 def parse_endpoints(rep):
     """
-    endpoints[]{"domain", "ip4", "ip6", "pubkey"}
-    list of dictionaries
-    reps: raw endpoints
-    """
-    i, j, endpoints = 0, 0, []
-    while i < len(rep):
-        if rep[i]["status"] == "UP":
-            while j < len(rep[i]["endpoints"]):
-                ep = parse_endpoint(rep[i]["endpoints"][j])
-                j += 1
-                if ep is None:
-                    break
-                ep["pubkey"] = rep[i]["pubkey"]
-                endpoints.append(ep)
-        i += 1
-        j = 0
+    Returns the BMA endpoints of the peers, with their pubkey.
+    The peers known as DOWN are left out, the ones of unknown status
+    (cached peers documents) are left to the connection probing.
+    rep: raw peers documents
+    """
+    endpoints = list()
+    for peer in rep:
+        if peer.get("status", "UP") != "UP":
+            continue
+        for raw_endpoint in peer["endpoints"]:
+            ep = parse_endpoint(raw_endpoint)
+            if ep is not None and ep.api in BMA_APIS:
+                endpoints.append(ep.with_pubkey(peer["pubkey"]))
     return endpoints
 
 
 def generate_duniterpy_endpoint_format(ep):
-    api = "BASIC_MERKLED_API " if ep["port"] != "443" else "BMAS "
+    if ep.get("api") in BMA_APIS:
+        api = ep["api"] + " "
+    else:
+        api = "BASIC_MERKLED_API " if ep["port"] != "443" else "BMAS "
     api += ep.get("domain") + " " if "domain" in ep else ""
     api += ep.get("ip4") + " " if "ip4" in ep else ""
     api += ep.get("ip6") + " " if "ip6" in ep else ""
     api += ep.get("port")
+    api += " " + ep["path"] if "path" in ep else ""
     return api
 
 
+class TokenBucket(object):
+    """
+    Paces requests to stay below BMA anti-spam limitations:
+    `rate` requests per second on average, bursts of `capacity` requests.
+    Can be shared between concurrent coroutines
+    """
+
+    def __init__(self, rate=BMA_REQUESTS_RATE, capacity=BMA_REQUESTS_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    async def acquire(self):
+        while True:
+            now = monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await sleep((1 - self.tokens) / self.rate)
+
+
 def singleton(class_):
     instances = {}
 
@@ -128,7 +475,6 @@ def singleton(class_):
 @singleton
 class EndPoint(object):
     def __init__(self):
-        ep = dict()
         try:
             from click.globals import get_current_context
 
@@ -139,91 +485,382 @@ class EndPoint(object):
         # except (ModuleNotFoundError, RuntimeError):
         except:
             peer, gtest = None, None
+        self.pinned = bool(peer)
         if peer:
-            if ":" in peer:
-                ep["domain"], ep["port"] = peer.rsplit(":", 1)
-            else:
-                ep["domain"], ep["port"] = peer, "443"
+            ep = parse_peer(peer)
         else:
+            ep = PeersCache(gtest).best()
+        if ep is None:
+            ep = dict()
             ep["domain"], ep["port"] = (
                 G1_TEST_DEFAULT_ENDPOINT if gtest else G1_DEFAULT_ENDPOINT
             )
-        if ep["domain"].startswith("[") and ep["domain"].endswith("]"):
-            ep["domain"] = ep["domain"][1:-1]
         self.ep = ep
-        api = "BMAS" if ep["port"] == "443" else "BASIC_MERKLED_API"
-        self.BMA_ENDPOINT = " ".join([api, ep["domain"], ep["port"]])
+        self.gtest = gtest
+        self.BMA_ENDPOINT = generate_duniterpy_endpoint_format(ep)
+
+
+def parse_peer(peer):
+    """
+    Returns the endpoint of a peer passed as <host>:<port>.
+    In case no port is specified, it defaults to 443
+    """
+    ep = dict()
+    if ":" in peer and not peer.endswith("]"):
+        ep["domain"], ep["port"] = peer.rsplit(":", 1)
+    else:
+        ep["domain"], ep["port"] = peer, "443"
+    if ep["domain"].startswith("[") and ep["domain"].endswith("]"):
+        ep["domain"] = ep["domain"][1:-1]
+    return ep
+
+
+class PooledClient(Client):
+    """
+    Client using the connection pool shared by all the nodes’ clients.
+    Closing it leaves the shared session open
+    """
+
+    def __init__(self, endpoint):
+        super().__init__(endpoint, session=get_shared_session())
+
+    async def close(self):
+        pass
+
+
+shared_session = {"session": None, "loop": None}
+
+
+def get_shared_session():
+    """
+    Returns the aiohttp session shared within the event loop.
+    Its connector keeps the connections alive, limits the connections per host,
+    and caches the DNS resolutions
+    """
+    loop = get_event_loop()
+    session = shared_session["session"]
+    if session is None or session.closed or shared_session["loop"] is not loop:
+        connector = TCPConnector(
+            limit=POOL_CONNECTIONS,
+            limit_per_host=POOL_CONNECTIONS_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        shared_session["session"] = ClientSession(connector=connector)
+        shared_session["loop"] = loop
+    return shared_session["session"]
+
+
+async def close_shared_session():
+    session = shared_session["session"]
+    if session is not None and not session.closed:
+        await session.close()
+    shared_session["session"] = None
 
 
 @singleton
 class ClientInstance(object):
     def __init__(self):
-        self.client = Client(EndPoint().BMA_ENDPOINT)
+        self.client = FailoverClient(*pool_endpoints())
+        start_peers_refresh(self.client)
+
+
+def pool_endpoints():
+    """
+    Returns the endpoints of the client’s nodes and their known latencies:
+    the node passed with --peer alone,
+    otherwise the main node and the fastest healthy cached peers
+    """
+    endpoint = EndPoint()
+    if endpoint.pinned:
+        return [endpoint.ep], [None]
+    endpoints, latencies = [endpoint.ep], [None]
+    for peer in PeersCache(endpoint.gtest).ranked():
+        if len(endpoints) == CLIENT_POOL_SIZE:
+            break
+        if endpoint_key(peer["endpoint"]) != endpoint_key(endpoint.ep):
+            endpoints.append(peer["endpoint"])
+            latencies.append(peer["latency"])
+    return endpoints, latencies
+
+
+class PoolNode(object):
+    """A node of the FailoverClient, with its latency and circuit breaker"""
+
+    def __init__(self, ep, latency=None):
+        self.ep = ep
+        self.latency = latency
+        self.failures = 0
+        self.opened = None
+        self.client = None
+
+    def get_client(self):
+        if self.client is None:
+            self.client = PooledClient(generate_duniterpy_endpoint_format(self.ep))
+        return self.client
+
+    def available(self):
+        """The circuit is closed, or half-open once CIRCUIT_BREAKER_DELAY elapsed"""
+        return self.opened is None or monotonic() - self.opened >= CIRCUIT_BREAKER_DELAY
+
+    def succeeded(self, latency):
+        self.failures, self.opened = 0, None
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= CIRCUIT_BREAKER_FAILURES:
+            self.opened = monotonic()
+
+
+class FailoverClient(object):
+    """
+    BMA client over several nodes, used as duniterpy’s Client.
+    Each request goes to the available node with the lowest latency,
+    a node with an unknown latency being tried first.
+    A node failing CIRCUIT_BREAKER_FAILURES times in a row is left aside
+    for CIRCUIT_BREAKER_DELAY seconds.
+    A failed GET request is retried on the other nodes,
+    while a POST request is never sent twice
+    """
+
+    def __init__(self, endpoints, latencies=None):
+        latencies = latencies or [None] * len(endpoints)
+        self.nodes = [PoolNode(ep, lat) for ep, lat in zip(endpoints, latencies)]
+
+    def __call__(self, _function, *args, **kwargs):
+        return _function(self, *args, **kwargs)
+
+    @property
+    def endpoint(self):
+        return self.pick(list()).get_client().endpoint
+
+    def pick(self, excluded):
+        """The fastest available node, or the fastest one if none is available"""
+        nodes = [node for node in self.nodes if node not in excluded]
+        if not nodes:
+            return None
+        available = [node for node in nodes if node.available()] or nodes
+        return min(
+            available, key=lambda node: -1 if node.latency is None else node.latency
+        )
+
+    async def get(self, url_path, params=None, rtype=RESPONSE_JSON, schema=None):
+        return await self.request("get", url_path, params, rtype, schema)
+
+    async def post(self, url_path, params=None, rtype=RESPONSE_JSON, schema=None):
+        return await self.request("post", url_path, params, rtype, schema)
+
+    async def request(self, method, *args):
+        tried = list()
+        while True:
+            node = self.pick(tried)
+            tried.append(node)
+            start = monotonic()
+            try:
+                response = await getattr(node.get_client(), method)(*args)
+            except DuniterError as e:
+                if e.ucode != HTTP_LIMITATION:
+                    raise
+                error = e
+            except (ClientError, TimeoutError, OSError) as e:
+                error = e
+            except ValueError as e:
+                # HTTP error status, such as a 502 or 503 behind a proxy
+                error = e
+            else:
+                node.succeeded(monotonic() - start)
+                return response
+            node.failed()
+            logging.warning(
+                "{} request to {} failed: {}".format(
+                    method.upper(), generate_duniterpy_endpoint_format(node.ep), error
+                )
+            )
+            if method != "get" or len(tried) == len(self.nodes):
+                raise error
+
+    async def connect_ws(self, path):
+        return await self.pick(list()).get_client().connect_ws(path)
+
+    async def close(self):
+        """
+        Close the shared connection pool used by the nodes’ clients.
+        The client can still be used afterwards
+        """
+        for node in self.nodes:
+            node.client = None
+        await close_shared_session()
+
+
+class EndpointRecord(Mapping):
+    """
+    Parsed endpoint: an immutable record, also read as a dict
+    of its set fields, for instance `ep["domain"]` or `"ip6" in ep`
+    """
+
+    __slots__ = FIELDS = (
+        "api",
+        "uuid",
+        "domain",
+        "ip4",
+        "ip6",
+        "port",
+        "path",
+        "pubkey",
+    )
+
+    def __init__(self, **fields):
+        for field in EndpointRecord.FIELDS:
+            object.__setattr__(self, field, fields.get(field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("EndpointRecord is immutable")
 
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in EndpointRecord.FIELDS else None
+        if value is None:
+            raise KeyError(key)
+        return value
 
+    def __iter__(self):
+        return (
+            field for field in EndpointRecord.FIELDS if getattr(self, field) is not None
+        )
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, field) for field in EndpointRecord.FIELDS))
+
+    def __repr__(self):
+        return "EndpointRecord({})".format(dict(self))
+
+    def with_pubkey(self, pubkey):
+        return EndpointRecord(**dict(self, pubkey=pubkey))
+
+
+@lru_cache(maxsize=ENDPOINTS_CACHE_SIZE)
 def parse_endpoint(rep):
     """
+    Parse a raw endpoint of the BMAS, BASIC_MERKLED_API, WS2P, WS2PTOR or GVA
+    kinds into an EndpointRecord. Memoized: each raw endpoint is parsed once.
+    Returns None for other kinds, or without valid port
     rep: raw endpoint, sep: split endpoint
     domain, ip4 or ip6 could miss on raw endpoint
     """
-    ep, sep = {}, rep.split(" ")
-    if sep[0] == "BASIC_MERKLED_API":
-        if check_port(sep[-1]):
-            ep["port"] = sep[-1]
-        if (
-            len(sep) == 5
-            and check_ip(sep[1]) == 0
-            and check_ip(sep[2]) == 4
-            and check_ip(sep[3]) == 6
-        ):
-            ep["domain"], ep["ip4"], ep["ip6"] = sep[1], sep[2], sep[3]
-        if len(sep) == 4:
-            ep = endpoint_type(sep[1], ep)
-            ep = endpoint_type(sep[2], ep)
-        if len(sep) == 3:
-            ep = endpoint_type(sep[1], ep)
-        return ep
-    else:
+    sep = rep.split(" ")
+    ep = {"api": sep.pop(0)}
+    if ep["api"] not in ENDPOINT_APIS:
         return None
+    if ep["api"] in ("WS2P", "WS2PTOR") and sep:
+        ep["uuid"] = sep.pop(0)
+    if ep["api"] == "GVA" and sep and sep[0] == "S":
+        ep["api"] += " " + sep.pop(0)
+    ports = [i for i, token in enumerate(sep) if token.isdigit()]
+    if not ports or not check_port(sep[ports[0]]):
+        return None
+    ep["port"] = sep[ports[0]]
+    for address in sep[: ports[0]]:
+        ep.setdefault(ADDRESS_TYPES[check_ip(address)], address)
+    if sep[ports[0] + 1 :]:
+        ep["path"] = " ".join(sep[ports[0] + 1 :])
+    return EndpointRecord(**ep)
 
 
-def endpoint_type(sep, ep):
-    typ = check_ip(sep)
-    if typ == 0:
-        ep["domain"] = sep
-    elif typ == 4:
-        ep["ip4"] = sep
-    elif typ == 6:
-        ep["ip6"] = sep
-    return ep
-
-
+@lru_cache(maxsize=ENDPOINTS_CACHE_SIZE)
 def check_ip(address):
-    if re.match(IPV4_REGEX, address) != None:
+    if IPV4_PATTERN.match(address):
         return 4
-    elif re.match(IPV6_REGEX, address) != None:
+    elif IPV6_PATTERN.match(address):
         return 6
     return 0
 
 
-def best_endpoint_address(ep, main):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(CONNECTION_TIMEOUT)
-    addresses, port = ("domain", "ip6", "ip4"), int(ep["port"])
-    for address in addresses:
-        if address in ep:
-            try:
-                s.connect((ep[address], port))
-                s.close()
-                return address
-            except Exception as e:
-                logging.debug(
-                    "Connection to endpoint %s (%s) failled (%s)" % (ep, address, e)
-                )
-    if main:
+async def best_endpoint_address(ep, main):
+    """
+    Returns the key of the endpoint’s first address accepting a connection.
+    If `main`, exits when none does
+    """
+    address, latency = await probe_endpoint(ep)
+    if address is None and main:
         print("Wrong node given as argument", file=stderr)
         exit(FAILURE_EXIT_STATUS)
-    return None
+    return address
+
+
+async def reachable_endpoints(endpoints, probes=None):
+    """
+    Returns the endpoints with an address accepting a connection.
+    Their probes, by endpoint key, are added to `probes` when given
+    """
+    results = await probe_endpoints(endpoints)
+    if probes is not None:
+        probes.update(zip(map(endpoint_key, endpoints), results))
+    return [ep for ep, (address, _) in zip(endpoints, results) if address is not None]
+
+
+async def probe_endpoints(endpoints, concurrency=PROBE_CONCURRENCY):
+    """
+    Probes all the endpoints concurrently,
+    with at most `concurrency` connection attempts at a time.
+    Returns their (address key, connect latency) in the endpoints order
+    """
+    semaphore = Semaphore(concurrency)
+    return await gather(*[probe_endpoint(ep, semaphore) for ep in endpoints])
+
+
+async def probe_endpoint(ep, semaphore=None):
+    """
+    Races connections to the endpoint’s domain, ip6 and ip4, happy eyeballs style:
+    an attempt starts when the previous one failed or after HAPPY_EYEBALLS_DELAY.
+    Returns the key of the first connected address and its connect latency,
+    (None, None) when none connects
+    """
+    if semaphore is None:
+        semaphore = Semaphore(PROBE_CONCURRENCY)
+    addresses = [address for address in ("domain", "ip6", "ip4") if address in ep]
+    attempts = dict()
+    pending = set()
+    try:
+        while addresses or pending:
+            if addresses:
+                address = addresses.pop(0)
+                attempt = ensure_future(
+                    connect_latency(ep[address], int(ep["port"]), semaphore)
+                )
+                attempts[attempt] = address
+                pending.add(attempt)
+            done, pending = await wait(
+                pending,
+                timeout=HAPPY_EYEBALLS_DELAY if addresses else None,
+                return_when=FIRST_COMPLETED,
+            )
+            for attempt in done:
+                if attempt.result() is not None:
+                    return attempts[attempt], attempt.result()
+    finally:
+        for attempt in pending:
+            attempt.cancel()
+    return None, None
+
+
+async def connect_latency(host, port, semaphore):
+    """Returns the time to open a connection to the host, None if it failed"""
+    async with semaphore:
+        start = monotonic()
+        try:
+            _, writer = await wait_for(open_connection(host, port), CONNECTION_TIMEOUT)
+        except (OSError, TimeoutError) as e:
+            logging.debug("Connection to %s:%s failed (%s)" % (host, port, e))
+            return None
+        latency = monotonic() - start
+        writer.close()
+        return latency
 
 
 def check_port(port):
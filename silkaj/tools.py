@@ -15,24 +15,29 @@ You should have received a copy of the GNU Affero General Public License
 along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 """
 
+from os import environ
 from sys import exit
+from pathlib import Path
 from asyncio import get_event_loop
 from functools import update_wrapper
 
-from silkaj.constants import G1_SYMBOL, GTEST_SYMBOL, FAILURE_EXIT_STATUS
-from silkaj.blockchain_tools import BlockchainParams
+from silkaj.constants import (
+    G1_SYMBOL,
+    GTEST_SYMBOL,
+    FAILURE_EXIT_STATUS,
+    CACHE_DIR_NAME,
+)
+from silkaj.blockchain_tools import BlockchainParams, head_watcher
+from silkaj.network_tools import close_shared_session, stop_peers_refresh
+from silkaj.async_cache import AsyncCache
 
 
 class CurrencySymbol(object):
-    __instance = None
+    cache = AsyncCache()
 
-    def __new__(cls):
-        if CurrencySymbol.__instance is None:
-            CurrencySymbol.__instance = object.__new__(cls)
-        return CurrencySymbol.__instance
-
-    def __init__(self):
-        self.symbol = self.get_symbol()
+    @property
+    def symbol(self):
+        return CurrencySymbol.cache.get("symbol", self.get_symbol)
 
     async def get_symbol(self):
         params = await BlockchainParams().params
@@ -42,6 +47,15 @@ class CurrencySymbol(object):
             return GTEST_SYMBOL
 
 
+# Called once the running command is done
+command_end_callbacks = list()
+
+
+def at_command_end(callback):
+    """Calls `callback` once the running command is done, to save a cache"""
+    command_end_callbacks.append(callback)
+
+
 def message_exit(message):
     print(message)
     exit(FAILURE_EXIT_STATUS)
@@ -50,6 +64,25 @@ def message_exit(message):
 def coroutine(f):
     def wrapper(*args, **kwargs):
         loop = get_event_loop()
-        return loop.run_until_complete(f(*args, **kwargs))
+        try:
+            return loop.run_until_complete(f(*args, **kwargs))
+        finally:
+            while command_end_callbacks:
+                command_end_callbacks.pop()()
+            loop.run_until_complete(stop_peers_refresh())
+            if head_watcher.running():
+                loop.run_until_complete(head_watcher.stop())
+            loop.run_until_complete(close_shared_session())
 
     return update_wrapper(wrapper, f)
+
+
+def get_cache_dir():
+    """
+    Returns Silkaj’s cache directory, created if missing.
+    Follows $XDG_CACHE_HOME, defaults to ~/.cache/silkaj
+    """
+    cache_home = environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    cache_dir = Path(cache_home) / CACHE_DIR_NAME
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
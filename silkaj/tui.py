@@ -51,15 +51,16 @@ async def display_pubkey(tx, message, pubkey):
 
 
 def display_pubkey_and_checksum(
-    pubkey, short=False, length=constants.SHORT_PUBKEY_SIZE
+    pubkey, short=False, length=constants.SHORT_PUBKEY_SIZE, checksum=None
 ):
     """
     Returns "<pubkey>:<checksum>" in full form.
     returns `length` first chars of pubkey and checksum in short form.
     `length` defaults to SHORT_PUBKEY_SIZE.
+    `checksum` is computed when not passed.
     """
     short_pubkey = pubkey[:length] + "…" if short else pubkey
-    return short_pubkey + ":" + ct.gen_checksum(pubkey)
+    return short_pubkey + ":" + (checksum or ct.gen_checksum(pubkey))
 
 
 async def send_doc_confirmation(document_name):
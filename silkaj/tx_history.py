@@ -26,7 +26,7 @@ from duniterpy.documents.transaction import Transaction
 from silkaj.network_tools import ClientInstance
 from silkaj.tools import coroutine
 from silkaj.tui import convert_time, display_pubkey_and_checksum
-from silkaj.crypto_tools import validate_checksum, check_pubkey_format
+from silkaj.crypto_tools import validate_checksum, check_pubkey_format, gen_checksums
 from silkaj import wot
 from silkaj.money import get_amount_from_pubkey, amount_in_current_base, UDValue
 from silkaj.tools import CurrencySymbol
@@ -137,7 +137,7 @@ async def parse_received_tx(
 ):
     """
     Extract issuers’ pubkeys
-    Get identities from pubkeys
+    Get identities and checksums from pubkeys
     Convert time into human format
     Assign identities
     Get amounts and assign amounts and amounts_ud
@@ -148,13 +148,14 @@ async def parse_received_tx(
         for issuer in received_tx.issuers:
             issuers.append(issuer)
     identities = await wot.identities_from_pubkeys(issuers, uids)
+    checksums = gen_checksums(issuers)
     for received_tx in received_txs:
         tx_list = list()
         tx_list.append(convert_time(received_tx.time, "all"))
         tx_list.append(str())
         for i, issuer in enumerate(received_tx.issuers):
             tx_list[1] += prefix(None, None, i) + assign_idty_from_pubkey(
-                issuer, identities, full_pubkey
+                issuer, identities, checksums, full_pubkey
             )
         amounts = tx_amount(received_tx, pubkey, received_func)[0]
         tx_list.append(amounts / 100)
@@ -166,7 +167,7 @@ async def parse_received_tx(
 async def parse_sent_tx(sent_txs_table, sent_txs, pubkey, ud_value, uids, full_pubkey):
     """
     Extract recipients’ pubkeys from outputs
-    Get identities from pubkeys
+    Get identities and checksums from pubkeys
     Convert time into human format
     Store "Total" and total amounts according to the number of outputs
     If not output back return:
@@ -180,6 +181,7 @@ async def parse_sent_tx(sent_txs_table, sent_txs, pubkey, ud_value, uids, full_p
                 pubkeys.append(output.condition.left.pubkey)
 
     identities = await wot.identities_from_pubkeys(pubkeys, uids)
+    checksums = gen_checksums(pubkeys)
     for sent_tx in sent_txs:
         tx_list = list()
         tx_list.append(convert_time(sent_tx.time, "all"))
@@ -203,7 +205,7 @@ async def parse_sent_tx(sent_txs_table, sent_txs, pubkey, ud_value, uids, full_p
                     round(neg(amount_in_current_base(output)) / ud_value, 2)
                 )
                 tx_list[1] += prefix(tx_list[1], outputs, 0) + assign_idty_from_pubkey(
-                    output.condition.left.pubkey, identities, full_pubkey
+                    output.condition.left.pubkey, identities, checksums, full_pubkey
                 )
         tx_list.append(amounts)
         tx_list.append(amounts_ud)
@@ -248,14 +250,13 @@ def output_available(condition, comparison, value):
         return False
 
 
-def assign_idty_from_pubkey(pubkey, identities, full_pubkey):
-    idty = display_pubkey_and_checksum(pubkey, short=not full_pubkey)
+def assign_idty_from_pubkey(pubkey, identities, checksums, full_pubkey):
+    idty = display_pubkey_and_checksum(
+        pubkey, short=not full_pubkey, checksum=checksums[pubkey]
+    )
     for identity in identities:
         if pubkey == identity["pubkey"]:
-            idty = "{0} - {1}".format(
-                identity["uid"],
-                display_pubkey_and_checksum(pubkey, short=not full_pubkey),
-            )
+            return "{0} - {1}".format(identity["uid"], idty)
     return idty
 
 
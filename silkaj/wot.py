@@ -16,19 +16,28 @@ along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 """
 
 import click
+import json
+from os import replace
 from time import time
 from tabulate import tabulate
 from collections import OrderedDict
 from asyncio import sleep
 from duniterpy.api.bma import wot, blockchain
-from duniterpy.api.errors import DuniterError
+from duniterpy.api.errors import DuniterError, NO_MEMBER_MATCHING_PUB_OR_UID
 
-from silkaj.network_tools import ClientInstance
+from silkaj.network_tools import ClientInstance, singleton
 from silkaj.crypto_tools import is_pubkey_and_check
-from silkaj.tools import message_exit, coroutine
+from silkaj.tools import message_exit, coroutine, get_cache_dir, at_command_end
 from silkaj.tui import convert_time, display_pubkey_and_checksum
-from silkaj.blockchain_tools import BlockchainParams
-from silkaj.constants import ASYNC_SLEEP
+from silkaj.blockchain_tools import BlockchainParams, params_source
+from silkaj.constants import (
+    ASYNC_SLEEP,
+    IDENTITY_CACHE_SIZE,
+    IDENTITY_CACHE_TTL,
+    IDENTITY_NEGATIVE_TTL,
+)
+
+IDENTITY_CACHE_FILENAME = "identities.json"
 
 
 def get_sent_certifications(signed, time_first_block, params):
@@ -123,7 +132,7 @@ async def membership_status(certifications, pubkey, req):
                 len(certifications["received"]) - params["sigQty"]
             ]
         )
-    member = await is_member(pubkey)
+    member = await is_member(pubkey, cached=False)
     if member:
         member = True
     print("member:", member)
@@ -184,7 +193,7 @@ async def id_pubkey_correspondence(id_pubkey):
         for pubkey in pubkeys:
             print("→", display_pubkey_and_checksum(pubkey["pubkey"]), end=" ")
             try:
-                corresponding_id = await client(wot.identity_of, pubkey["pubkey"])
+                corresponding_id = await identity_of(pubkey["pubkey"])
                 print("↔ " + corresponding_id["uid"])
             except:
                 print("")
@@ -237,26 +246,131 @@ async def choose_identity(pubkey_uid):
     )
 
 
-async def identity_of(pubkey_uid):
+async def identity_of(pubkey_uid, cached=True):
     """
     Only works for members
     Not able to get corresponding uid from a non-member identity
     Able to know if an identity is member or not
+    Identities are cached, non-members included.
+    `cached=False` requests the node and refreshes the cache
     """
-    client = ClientInstance().client
-    try:
-        return await client(wot.identity_of, pubkey_uid)
-    except ValueError as e:
-        pass
+    cache = IdentityCache()
+    entry = cache.lookup(pubkey_uid) if cached else None
+    if entry is None:
+        client = ClientInstance().client
+        try:
+            identity = await client(wot.identity_of, pubkey_uid)
+        except ValueError as e:
+            return None
+        except DuniterError as e:
+            if e.ucode != NO_MEMBER_MATCHING_PUB_OR_UID:
+                raise
+            identity = None
+        entry = cache.store(pubkey_uid, identity)
+    if entry[0] is None:
+        raise DuniterError(
+            {
+                "ucode": NO_MEMBER_MATCHING_PUB_OR_UID,
+                "message": "No member matching this pubkey or uid",
+            }
+        )
+    return entry[0]
+
+
+@singleton
+class IdentityCache(object):
+    """
+    Members’ identities by pubkey or uid, with the time they were requested.
+    An in-process LRU of IDENTITY_CACHE_SIZE entries, backed by a file of the
+    cache directory, unless `persistent` is False or the file can not be written.
+    The file is written once, at the end of the command.
+    Identities expire after IDENTITY_CACHE_TTL, non-members after
+    IDENTITY_NEGATIVE_TTL
+    """
+
+    def __init__(self, persistent=True):
+        self.memory = OrderedDict()
+        self.persistent = persistent
+        self.source = params_source()
+        self.disk = dict()
+        self.dirty = False
+        if persistent:
+            try:
+                self.path = get_cache_dir() / IDENTITY_CACHE_FILENAME
+            except OSError:
+                self.persistent = False
+            else:
+                try:
+                    with self.path.open() as cache_file:
+                        self.disk = json.load(cache_file)
+                except (OSError, ValueError):
+                    pass
+
+    def lookup(self, pubkey_uid):
+        """Returns the fresh (identity, time) entry, None without any"""
+        entry = self.memory.get(pubkey_uid)
+        if entry is None:
+            entry = self.disk.get(self.source, dict()).get(pubkey_uid)
+            if entry is None:
+                return None
+            self.remember(pubkey_uid, entry)
+        self.memory.move_to_end(pubkey_uid)
+        return entry if fresh_identity(entry) else None
+
+    def store(self, pubkey_uid, identity):
+        """Cache an identity, None for a non-member"""
+        entry = (identity, time())
+        self.remember(pubkey_uid, entry)
+        if self.persistent:
+            self.disk.setdefault(self.source, dict())[pubkey_uid] = entry
+            if not self.dirty:
+                self.dirty = True
+                at_command_end(self.save)
+        return entry
+
+    def remember(self, pubkey_uid, entry):
+        self.memory[pubkey_uid] = entry
+        self.memory.move_to_end(pubkey_uid)
+        while len(self.memory) > IDENTITY_CACHE_SIZE:
+            self.memory.popitem(last=False)
+
+    def save(self):
+        """Drop the expired entries and write the stored identities atomically"""
+        if not self.persistent or not self.dirty:
+            return
+        self.dirty = False
+        for source, entries in self.disk.items():
+            self.disk[source] = {
+                key: entry for key, entry in entries.items() if fresh_identity(entry)
+            }
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            with tmp_path.open("w") as cache_file:
+                json.dump(self.disk, cache_file)
+            replace(str(tmp_path), str(self.path))
+        except OSError:
+            self.persistent = False
+
+    def clear(self):
+        """Forget the cached identities"""
+        self.memory.clear()
+        self.disk.clear()
+
+
+def fresh_identity(entry):
+    identity, requested = entry
+    ttl = IDENTITY_NEGATIVE_TTL if identity is None else IDENTITY_CACHE_TTL
+    return time() - requested < ttl
 
 
-async def is_member(pubkey_uid):
+async def is_member(pubkey_uid, cached=True):
     """
     Check identity is member
     If member, return corresponding identity, else: False
+    Pass `cached=False` for the checks deciding on a document to send
     """
     try:
-        return await identity_of(pubkey_uid)
+        return await identity_of(pubkey_uid, cached)
     except:
         return False
 
@@ -287,10 +401,14 @@ async def identities_from_pubkeys(pubkeys, uids):
 
     uniq_pubkeys = list(filter(None, set(pubkeys)))
     identities = list()
+    cache = IdentityCache()
     for pubkey in uniq_pubkeys:
+        # Only the requests are paced
+        requested = cache.lookup(pubkey) is None
         try:
             identities.append(await identity_of(pubkey))
         except Exception as e:
             pass
-        await sleep(ASYNC_SLEEP)
+        if requested:
+            await sleep(ASYNC_SLEEP)
     return identities
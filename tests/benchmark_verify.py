@@ -0,0 +1,306 @@
+"""
+Copyright  2016-2021 Maël Azimi <m.a@moul.re>
+
+Silkaj is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Silkaj is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""
+Benchmark of `silkaj verify` against a local fake BMA server.
+
+The server serves a generated corpus of signed and chained blocks,
+so that the verification throughput is measured without a real node:
+
+    poetry run python tests/benchmark_verify.py --blocks 20000
+
+It reports the blocks per second, the peak RSS, and the time spent
+downloading, parsing and verifying the blocks.
+The split is measured in-process, thus only with a single job.
+"""
+
+import json
+import resource
+import sys
+from os import environ
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from threading import Thread, Event
+from time import monotonic
+from asyncio import new_event_loop, set_event_loop
+from aiohttp import web
+from click import command, option, IntRange
+from click.testing import CliRunner
+
+from duniterpy.documents import Block
+from duniterpy.key import SigningKey
+
+from silkaj import cli, blocks
+from silkaj.network_tools import FailoverClient
+
+CURRENCY = "g1-bench"
+BENCHMARK_SEED = "1" * 64
+
+
+def gen_corpus(count, currency=CURRENCY, invalid=()):
+    """
+    Returns `count` signed and chained blocks, from block 1, in BMA JSON format.
+    Blocks with a number within `invalid` get a wrong signature
+    """
+    key = SigningKey.from_seedhex(BENCHMARK_SEED)
+    corpus, previous_hash = list(), "0" * 64
+    for number in range(1, count + 1):
+        block = Block(
+            version=12,
+            currency=currency,
+            number=number,
+            powmin=80,
+            time=1488987127 + number * 300,
+            mediantime=1488987127 + number * 300,
+            ud=None,
+            unit_base=0,
+            issuer=key.pubkey,
+            issuers_frame=1,
+            issuers_frame_var=0,
+            different_issuers_count=0,
+            prev_hash=previous_hash,
+            prev_issuer=key.pubkey,
+            parameters=None,
+            members_count=59,
+            identities=[],
+            joiners=[],
+            actives=[],
+            leavers=[],
+            revokations=[],
+            excluded=[],
+            certifications=[],
+            transactions=[],
+            inner_hash="",
+            nonce=number,
+            signature="",
+        )
+        block.inner_hash = block.computed_inner_hash()
+        block.sign([key])
+        if number in invalid:
+            block.signatures = [corpus[0]["signature"]]
+        previous_hash = block.proof_of_work()
+        corpus.append(block_json(block, previous_hash))
+    return corpus
+
+
+def block_json(block, hash):
+    """Fields of the BMA blocks JSON schema used by `verify`"""
+    return {
+        "version": block.version,
+        "currency": block.currency,
+        "nonce": block.nonce,
+        "number": block.number,
+        "time": block.time,
+        "medianTime": block.mediantime,
+        "dividend": None,
+        "monetaryMass": 0,
+        "issuer": block.issuer,
+        "previousHash": block.prev_hash,
+        "previousIssuer": block.prev_issuer,
+        "membersCount": block.members_count,
+        "hash": hash,
+        "inner_hash": block.inner_hash,
+        "identities": [],
+        "joiners": [],
+        "leavers": [],
+        "excluded": [],
+        "certifications": [],
+        "transactions": [],
+        "raw": block.raw(),
+        "signature": block.signatures[0],
+    }
+
+
+class FakeBMAServer(object):
+    """
+    Serves `blockchain/current`, `blockchain/block/{number}` and
+    `blockchain/blocks/{count}/{from}` from the corpus,
+    on a local port, within its own thread and event loop
+    """
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.port = None
+        self.requests = 0
+        self.started = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        self.started.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def run(self):
+        self.loop = new_event_loop()
+        set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_get("/blockchain/current", self.current)
+        app.router.add_get("/blockchain/block/{number}", self.block)
+        app.router.add_get("/blockchain/blocks/{count}/{start}", self.blocks)
+        runner = web.AppRunner(app)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        self.port = runner.addresses[0][1]
+        self.started.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(runner.cleanup())
+        self.loop.close()
+
+    def response(self, data):
+        self.requests += 1
+        return web.Response(text=json.dumps(data), content_type="application/json")
+
+    async def current(self, request):
+        return self.response(self.corpus[-1])
+
+    async def block(self, request):
+        number = int(request.match_info["number"])
+        if not 1 <= number <= len(self.corpus):
+            return web.json_response(
+                {"ucode": 2011, "message": "Block not found"}, status=404
+            )
+        return self.response(self.corpus[number - 1])
+
+    async def blocks(self, request):
+        count = int(request.match_info["count"])
+        start = int(request.match_info["start"])
+        return self.response(self.corpus[max(start, 1) - 1 : start - 1 + count])
+
+
+class Timer(object):
+    """Accumulates the time spent within the wrapped functions"""
+
+    def __init__(self):
+        self.spent = 0
+
+    def wrap(self, function):
+        def wrapper(*args, **kwargs):
+            start = monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.spent += monotonic() - start
+
+        return wrapper
+
+    def wrap_async(self, function):
+        async def wrapper(*args, **kwargs):
+            start = monotonic()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self.spent += monotonic() - start
+
+        return wrapper
+
+
+def peak_rss():
+    """Peak resident set size of the process, in MiB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+def run_benchmark(corpus, jobs=1, chain=False, options=()):
+    """
+    Runs `silkaj verify` over the whole corpus against the fake server,
+    with an empty blocks store and the additional `options`. Returns the measures
+    """
+    fetch, parse, verify = Timer(), Timer(), Timer()
+    args = ["verify", "1", str(len(corpus)), "--jobs", str(jobs)]
+    args += ["--chain"] if chain else []
+    args += list(options)
+    with FakeBMAServer(corpus) as server, TemporaryDirectory() as cache:
+        # ClientInstance is a singleton which could already point to other nodes
+        client = FailoverClient([{"ip4": "127.0.0.1", "port": str(server.port)}])
+        patched = {
+            "ClientInstance": lambda: SimpleNamespace(client=client),
+            "get_blocks": fetch.wrap_async(blocks.get_blocks),
+        }
+        # The processes pool can not pickle the wrappers
+        if jobs == 1:
+            patched["verify_signed_raws"] = parse.wrap(blocks.verify_signed_raws)
+            patched["verify_block_signature"] = verify.wrap(
+                blocks.verify_block_signature
+            )
+            patched["verify_raw_signature"] = verify.wrap(blocks.verify_raw_signature)
+        originals = {name: getattr(blocks, name) for name in patched}
+        cache_home = environ.get("XDG_CACHE_HOME")
+        environ["XDG_CACHE_HOME"] = cache
+        for name, function in patched.items():
+            setattr(blocks, name, function)
+        start = monotonic()
+        try:
+            result = CliRunner(mix_stderr=False).invoke(cli.cli, args)
+        finally:
+            elapsed = monotonic() - start
+            for name, function in originals.items():
+                setattr(blocks, name, function)
+            if cache_home is None:
+                del environ["XDG_CACHE_HOME"]
+            else:
+                environ["XDG_CACHE_HOME"] = cache_home
+    if result.exit_code:
+        raise RuntimeError(result.output) from result.exception
+    return {
+        "blocks": len(corpus),
+        "jobs": jobs,
+        "elapsed": elapsed,
+        "blocks_per_second": len(corpus) / elapsed,
+        "peak_rss": peak_rss(),
+        "fetch": fetch.spent,
+        # Parsing is what remains of the slices’ processing after the verification
+        "parse": parse.spent - verify.spent if jobs == 1 else None,
+        "verify": verify.spent if jobs == 1 else None,
+        "requests": server.requests,
+        "output": result.output,
+    }
+
+
+def display_measures(measures):
+    print("Blocks: {blocks}, jobs: {jobs}".format(**measures))
+    print("Elapsed: {elapsed:.2f} s".format(**measures))
+    print("Throughput: {blocks_per_second:.0f} blocks/s".format(**measures))
+    print("Peak RSS: {peak_rss:.1f} MiB".format(**measures))
+    print("BMA requests: {requests}".format(**measures))
+    print("Fetch: {fetch:.2f} s, overlapping the verification".format(**measures))
+    if measures["verify"] is not None:
+        print("Parse: {parse:.2f} s".format(**measures))
+        print("Verify: {verify:.2f} s".format(**measures))
+
+
+@command(help="Benchmark `silkaj verify` against a local fake BMA server")
+@option("--blocks", default=20000, show_default=True, type=IntRange(1))
+@option("--jobs", "-j", default=1, show_default=True, type=IntRange(1))
+@option("--chain", "-c", is_flag=True, help="Also verify the hash chain")
+@option("--json", "as_json", is_flag=True, help="Output the measures as JSON")
+def benchmark(blocks, jobs, chain, as_json):
+    corpus = gen_corpus(blocks)
+    measures = run_benchmark(corpus, jobs, chain)
+    if as_json:
+        del measures["output"]
+        print(json.dumps(measures))
+    else:
+        display_measures(measures)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,43 @@
+"""
+Copyright  2016-2021 Maël Azimi <m.a@moul.re>
+
+Silkaj is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Silkaj is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import pytest
+
+from silkaj.tools import CurrencySymbol
+from silkaj.blockchain_tools import BlockchainParams, HeadBlock
+from silkaj.money import UDValue
+from silkaj import network_tools
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    """Keep the caches written by the tests out of the user’s cache directory"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+
+@pytest.fixture(autouse=True)
+def no_peers_refresh(monkeypatch):
+    """The tests do not crawl the real network in the background"""
+    monkeypatch.setattr(network_tools, "start_peers_refresh", lambda client: None)
+
+
+@pytest.fixture(autouse=True)
+def async_caches():
+    """Values cached by a test, with its patches, are not served to the next ones"""
+    yield
+    for cached in (CurrencySymbol, BlockchainParams, HeadBlock, UDValue):
+        cached.cache.invalidate()
@@ -0,0 +1,102 @@
+"""
+Copyright  2016-2021 Maël Azimi <m.a@moul.re>
+
+Silkaj is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Silkaj is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import pytest
+from asyncio import gather, sleep, ensure_future, CancelledError
+
+from silkaj.async_cache import AsyncCache
+from silkaj.blockchain_tools import HeadBlock
+
+
+class Fetcher(object):
+    def __init__(self, delay=0.01, fail=False):
+        self.delay, self.fail = delay, fail
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await sleep(self.delay)
+        if self.fail:
+            raise ValueError("failed")
+        return self.calls
+
+
+@pytest.mark.asyncio
+async def test_async_cache_single_flight():
+    cache, fetch = AsyncCache(), Fetcher()
+    assert await gather(*[cache.get("key", fetch) for _ in range(5)]) == [1] * 5
+    assert await cache.get("key", fetch) == 1
+    assert fetch.calls == 1
+    assert cache.stats() == {"hits": 1, "misses": 1, "shared": 4, "size": 1}
+
+
+@pytest.mark.asyncio
+async def test_async_cache_ttl():
+    cache, fetch = AsyncCache(ttl=0.05), Fetcher(delay=0)
+    assert await cache.get("short", fetch) == 1
+    assert await cache.get("long", fetch, ttl=None) == 2
+    assert await cache.get("short", fetch) == 1
+    await sleep(0.06)
+    assert await cache.get("short", fetch) == 3
+    assert await cache.get("long", fetch) == 2
+
+
+@pytest.mark.asyncio
+async def test_async_cache_invalidate():
+    cache, fetch = AsyncCache(), Fetcher()
+    pending = ensure_future(cache.get("key", fetch))
+    await sleep(0)
+    cache.invalidate("key")
+    # The result of the invalidated call is returned, but not cached
+    assert await pending == 1
+    assert await cache.get("key", fetch) == 2
+    cache.invalidate()
+    assert await cache.get("key", fetch) == 3
+
+
+@pytest.mark.asyncio
+async def test_async_cache_failures():
+    cache, fetch = AsyncCache(), Fetcher(fail=True)
+    with pytest.raises(ValueError):
+        await cache.get("key", fetch)
+    fetch.fail = False
+    assert await cache.get("key", fetch) == 2
+    assert cache.stats()["size"] == 1
+
+
+@pytest.mark.asyncio
+async def test_async_cache_cancelled_caller():
+    cache, fetch = AsyncCache(), Fetcher()
+    first = ensure_future(cache.get("key", fetch))
+    second = ensure_future(cache.get("key", fetch))
+    await sleep(0)
+    first.cancel()
+    with pytest.raises(CancelledError):
+        await first
+    assert await second == 1 and fetch.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_head_block_single_flight(monkeypatch):
+    fetch = Fetcher()
+
+    async def patched_head(self):
+        return {"number": await fetch()}
+
+    monkeypatch.setattr(HeadBlock, "get_head", patched_head)
+    heads = await gather(*[HeadBlock().head_block for _ in range(3)])
+    assert heads == [{"number": 1}] * 3 and fetch.calls == 1
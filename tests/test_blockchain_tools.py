@@ -0,0 +1,211 @@
+"""
+Copyright  2016-2021 Maël Azimi <m.a@moul.re>
+
+Silkaj is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Silkaj is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import pytest
+from asyncio import Queue, wait_for, sleep
+from types import SimpleNamespace
+from aiohttp.client_exceptions import ClientConnectionError
+from duniterpy.api import bma
+from duniterpy.api.bma import blockchain
+
+from silkaj import blockchain_tools
+from silkaj.blockchain_tools import BlockchainParams, HeadBlock, head_watcher
+
+
+def ws_block(number):
+    return {
+        "version": 12,
+        "nonce": 1,
+        "number": number,
+        "powMin": 80,
+        "time": 1592243760 + number,
+        "medianTime": 1592243760 + number,
+        "membersCount": 2800,
+        "monetaryMass": 0,
+        "unitbase": 0,
+        "issuersCount": 10,
+        "issuersFrame": 50,
+        "issuersFrameVar": 0,
+        "currency": "g1",
+        "issuer": "issuer",
+        "signature": "signature",
+        "hash": "{:064d}".format(number),
+        "parameters": "",
+        "previousHash": "{:064d}".format(number - 1),
+        "previousIssuer": "issuer",
+        "inner_hash": "inner_hash",
+        "dividend": None,
+        "identities": [],
+        "joiners": [],
+        "actives": [],
+        "leavers": [],
+        "revoked": [],
+        "excluded": [],
+        "certifications": [],
+        "transactions": [],
+    }
+
+
+class FakeWebSocket(object):
+    def __init__(self):
+        self.blocks = Queue()
+        self.closed = False
+
+    async def receive_json(self, timeout=None):
+        block = await self.blocks.get()
+        if block is None:
+            raise TypeError("Received message 258:None is not str")
+        return block
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeClient(object):
+    """Serves `blockchain/current` and the `ws/block` websocket, when it is up"""
+
+    def __init__(self, number, ws_up=True):
+        self.head = ws_block(number)
+        self.ws_up = ws_up
+        self.ws = None
+        self.polls = 0
+
+    async def __call__(self, request):
+        if request is bma.ws.block:
+            if not self.ws_up:
+                raise ClientConnectionError("websocket down")
+            self.ws = FakeWebSocket()
+            return self.ws
+        self.polls += 1
+        return self.head
+
+
+def start_watcher(client, monkeypatch):
+    monkeypatch.setattr(
+        blockchain_tools, "ClientInstance", lambda: SimpleNamespace(client=client)
+    )
+    monkeypatch.setattr(blockchain_tools, "HEAD_RECONNECT_DELAY", 0.05)
+    monkeypatch.setattr(blockchain_tools, "HEAD_POLL_INTERVAL", 0.01)
+    head_watcher.start()
+    return head_watcher
+
+
+@pytest.mark.asyncio
+async def test_head_block_watcher_websocket(monkeypatch):
+    client = FakeClient(100)
+    watcher = start_watcher(client, monkeypatch)
+    try:
+        head = await wait_for(watcher.current(), 1)
+        assert head["number"] == 100
+        assert (await HeadBlock().head_block) is head
+        client.ws.blocks.put_nowait(ws_block(101))
+        head = await wait_for(watcher.new_head(head), 1)
+        assert head["number"] == 101 and client.polls == 1
+        # An older block is ignored
+        client.ws.blocks.put_nowait(ws_block(99))
+        client.ws.blocks.put_nowait(ws_block(102))
+        assert (await wait_for(watcher.new_head(head), 1))["number"] == 102
+        # On disconnection, the head is polled, then the websocket reconnected
+        ws, client.head = client.ws, ws_block(103)
+        ws.blocks.put_nowait(None)
+        assert (await wait_for(watcher.new_head(watcher.head), 1))["number"] == 103
+        assert ws.closed
+    finally:
+        await watcher.stop()
+    assert not watcher.running()
+
+
+@pytest.mark.asyncio
+async def test_head_block_watcher_polling(monkeypatch):
+    client = FakeClient(100, ws_up=False)
+    watcher = start_watcher(client, monkeypatch)
+    try:
+        head = await wait_for(watcher.current(), 1)
+        client.head = ws_block(101)
+        assert (await wait_for(watcher.new_head(head), 1))["number"] == 101
+        assert client.polls >= 2
+        client.ws_up = True
+        while client.ws is None:
+            await sleep(0.01)
+        client.ws.blocks.put_nowait(ws_block(102))
+        assert (await wait_for(watcher.new_head(watcher.head), 1))["number"] == 102
+    finally:
+        await watcher.stop()
+
+
+class FakeParamsClient(object):
+    def __init__(self):
+        self.genesis = {"currency": "g1", "hash": "A" * 64}
+        self.requests = list()
+
+    async def __call__(self, request, *args):
+        self.requests.append(request)
+        if request is blockchain.block:
+            return self.genesis
+        return {"currency": "g1", "msValidity": 31557600}
+
+
+@pytest.mark.asyncio
+async def test_blockchain_params_cache(tmp_path, monkeypatch):
+    client = FakeParamsClient()
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(
+        blockchain_tools, "ClientInstance", lambda: SimpleNamespace(client=client)
+    )
+    monkeypatch.setattr(
+        blockchain_tools,
+        "EndPoint",
+        lambda: SimpleNamespace(pinned=False, gtest=False, BMA_ENDPOINT=None),
+    )
+    params = await BlockchainParams().params
+    assert params["msValidity"] == 31557600
+    assert sorted(r.__name__ for r in client.requests) == ["block", "parameters"]
+    # Served from the disk, with no request
+    BlockchainParams.cache.invalidate()
+    client.requests.clear()
+    assert await BlockchainParams().params == params
+    assert client.requests == []
+    # Once expired, only the genesis block is checked
+    monkeypatch.setattr(blockchain_tools, "PARAMS_CACHE_TTL", 0)
+    BlockchainParams.cache.invalidate()
+    assert await BlockchainParams().params == params
+    assert client.requests == [blockchain.block]
+    # A restarted currency gets its parameters requested again
+    client.requests.clear()
+    client.genesis = {"currency": "g1", "hash": "B" * 64}
+    BlockchainParams.cache.invalidate()
+    assert await BlockchainParams().params == params
+    assert client.requests.count(blockchain.parameters) == 1
+    cache = blockchain_tools.ParamsCache()
+    assert set(cache.parameters) == {"g1:" + "A" * 64, "g1:" + "B" * 64}
+    assert cache.sources["g1"]["key"] == "g1:" + "B" * 64
+
+
+@pytest.mark.asyncio
+async def test_blockchain_params_unwritable_cache(monkeypatch):
+    client = FakeParamsClient()
+    monkeypatch.setenv("XDG_CACHE_HOME", "/proc/nonexistent")
+    monkeypatch.setattr(
+        blockchain_tools, "ClientInstance", lambda: SimpleNamespace(client=client)
+    )
+    monkeypatch.setattr(
+        blockchain_tools,
+        "EndPoint",
+        lambda: SimpleNamespace(pinned=False, gtest=False, BMA_ENDPOINT=None),
+    )
+    assert (await BlockchainParams().params)["msValidity"] == 31557600
+    assert blockchain_tools.ParamsCache().path is None
@@ -0,0 +1,99 @@
+"""
+Copyright  2016-2021 Maël Azimi <m.a@moul.re>
+
+Silkaj is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Silkaj is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import pytest
+
+from silkaj.blocks import get_blocks, ChunkFetcher
+from silkaj.blocks_store import BlocksStore
+from silkaj.constants import FORK_WINDOW_SIZE
+
+HEAD_BLOCK = 1000
+
+
+def gen_blocks(count, start):
+    return [
+        {"number": number, "hash": str(number)}
+        for number in range(start, start + count)
+    ]
+
+
+def test_blocks_store(tmp_path):
+    store = BlocksStore("g1", HEAD_BLOCK, tmp_path / "blocks.sqlite")
+    assert store.get_blocks(10, 0) == list()
+    store.add_blocks(gen_blocks(20, 0))
+    store.add_blocks(gen_blocks(10, 30))
+    # contiguous blocks only
+    assert store.get_blocks(40, 0) == gen_blocks(20, 0)
+    assert store.get_blocks(5, 32) == gen_blocks(5, 32)
+    assert store.get_blocks(5, 25) == list()
+    store.close()
+
+    # persistence
+    store = BlocksStore("g1", HEAD_BLOCK, tmp_path / "blocks.sqlite")
+    assert store.get_blocks(10, 10) == gen_blocks(10, 10)
+    store.close()
+
+
+def test_blocks_store_fork_window(tmp_path):
+    store = BlocksStore("g1", HEAD_BLOCK, tmp_path / "blocks.sqlite")
+    store.add_blocks(
+        gen_blocks(2 * FORK_WINDOW_SIZE, HEAD_BLOCK - 2 * FORK_WINDOW_SIZE + 1)
+    )
+    assert store.get_blocks(
+        2 * FORK_WINDOW_SIZE, HEAD_BLOCK - 2 * FORK_WINDOW_SIZE + 1
+    ) == gen_blocks(FORK_WINDOW_SIZE, HEAD_BLOCK - 2 * FORK_WINDOW_SIZE + 1)
+    store.close()
+
+
+@pytest.mark.parametrize(
+    "node_blocks, kept",
+    [(gen_blocks(20, 0), True), ([{"number": 19, "hash": "restarted"}], False)],
+)
+@pytest.mark.asyncio
+async def test_blocks_store_check_tip(node_blocks, kept, tmp_path):
+    async def client(request, number):
+        return node_blocks[number - node_blocks[0]["number"]]
+
+    store = BlocksStore("g1", HEAD_BLOCK, tmp_path / "blocks.sqlite")
+    assert await store.check_tip(client)
+    store.add_blocks(gen_blocks(20, 0))
+    assert await store.check_tip(client) == kept
+    assert store.get_blocks(20, 0) == (gen_blocks(20, 0) if kept else list())
+    store.close()
+
+
+@pytest.mark.parametrize("count, start", [(10, 0), (50, 5), (30, 40)])
+@pytest.mark.asyncio
+async def test_get_blocks(count, start, tmp_path):
+    requested = list()
+
+    async def client(request, count, start):
+        requested.append((count, start))
+        return gen_blocks(count, start)
+
+    store = BlocksStore("g1", HEAD_BLOCK, tmp_path / "blocks.sqlite")
+    store.add_blocks(gen_blocks(20, 0))
+    assert await get_blocks(ChunkFetcher(client), store, count, start) == gen_blocks(
+        count, start
+    )
+    if start + count <= 20:
+        assert requested == list()
+    else:
+        tip = max(start, 20)
+        assert requested == [(start + count - tip, tip)]
+    assert store.get_blocks(count, start) == gen_blocks(count, start)
+    store.close()
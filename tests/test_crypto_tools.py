@@ -30,6 +30,19 @@ def test_gen_checksum(pubkey, checksum):
     assert checksum == crypto_tools.gen_checksum(pubkey)
 
 
+def test_gen_checksums():
+    crypto_tools.gen_checksum.cache_clear()
+    pubkeys = [
+        "J4c8CARmP9vAFNGtHRuzx14zvxojyRWHW2darguVqjtX",
+        "3rp7ahDGeXqffBQTnENiXEFXYS7BRjYmS33NbgfCuDc8",
+    ]
+    checksums = crypto_tools.gen_checksums(pubkeys * 3)
+    assert checksums == {pubkeys[0]: "KAv", pubkeys[1]: "DFQ"}
+    assert crypto_tools.gen_checksum.cache_info().misses == 2
+    crypto_tools.gen_checksum(pubkeys[0])
+    assert crypto_tools.gen_checksum.cache_info().hits == 1
+
+
 # test validate_checksum
 @pytest.mark.parametrize(
     "pubkey, checksum,  expected",
@@ -16,14 +16,17 @@ along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 """
 
 import pytest
+from types import SimpleNamespace
 from click.testing import CliRunner
 
 import duniterpy.api.bma.tx as bma_tx
+from duniterpy.api.bma import blockchain
 
 # had to import from wot to prevent loop dependencies
 from silkaj.wot import display_pubkey_and_checksum
 from silkaj.cli import cli
 from silkaj.constants import FAILURE_EXIT_STATUS
+from silkaj import money
 from silkaj.money import get_sources
 
 
@@ -149,3 +152,78 @@ def test_balance_errors():
     result = CliRunner().invoke(cli, ["balance"])
     assert "You should specify one or many pubkeys" in result.output
     assert result.exit_code == FAILURE_EXIT_STATUS
+
+
+UD_PARAMS = {"udTime0": 1488970800, "dt": 86400}
+
+
+@pytest.mark.parametrize(
+    "median_time, next_time",
+    [
+        (1488970800, 1488970800 + 86400),
+        (1488970800 + 86400 * 10 + 300, 1488970800 + 86400 * 11),
+    ],
+)
+def test_next_ud_time(median_time, next_time):
+    assert money.next_ud_time({"medianTime": median_time}, UD_PARAMS) == next_time
+
+
+@pytest.mark.asyncio
+async def test_ud_value_cache(tmp_path, monkeypatch):
+    requests = list()
+    ud_block = {"number": 100, "dividend": 1000, "unitbase": 0}
+    ud_block["medianTime"] = UD_PARAMS["udTime0"] + 300
+    head = {"medianTime": UD_PARAMS["udTime0"] + 600}
+
+    async def client(request, *args):
+        requests.append(request)
+        if request is blockchain.ud:
+            return {"result": {"blocks": [ud_block["number"]]}}
+        return ud_block
+
+    async def patched_head(self):
+        requests.append("head")
+        return head
+
+    async def patched_params(self):
+        return UD_PARAMS
+
+    async def ud_value():
+        # Skip the in-process caches, to get the UD value from the disk
+        money.UDValue.cache.invalidate()
+        money.HeadBlock.cache.invalidate()
+        return await money.UDValue().ud_value
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(money, "params_source", lambda: "g1")
+    monkeypatch.setattr(money, "time", lambda: head["medianTime"])
+    monkeypatch.setattr(money, "ClientInstance", lambda: SimpleNamespace(client=client))
+    monkeypatch.setattr(money.HeadBlock, "get_head", patched_head)
+    monkeypatch.setattr(money.BlockchainParams, "get_params", patched_params)
+
+    assert await ud_value() == 1000
+    assert requests == [blockchain.ud, blockchain.block]
+    # Before the next UD time, the value is served with no request
+    requests.clear()
+    assert await ud_value() == 1000
+    assert requests == []
+    # The time passed the next UD time, but not the median time
+    monkeypatch.setattr(money, "time", lambda: UD_PARAMS["udTime0"] + 86400)
+    assert await ud_value() == 1000
+    assert requests == ["head"]
+    # The new UD is requested once the median time passed it
+    requests.clear()
+    head["medianTime"] = UD_PARAMS["udTime0"] + 86400
+    ud_block = {"number": 388, "dividend": 1002, "unitbase": 0}
+    ud_block["medianTime"] = head["medianTime"]
+    assert await ud_value() == 1002
+    assert requests == ["head", blockchain.ud, blockchain.block]
+    assert money.UDCache().ud["g1"]["next_time"] == UD_PARAMS["udTime0"] + 86400 * 2
+
+
+def test_ud_cache_unwritable(monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", "/proc/nonexistent")
+    cache = money.UDCache()
+    cache.ud["g1"] = {"number": 100, "value": 1000, "next_time": 0}
+    cache.save()
+    assert cache.path is None and money.UDCache().ud == dict()
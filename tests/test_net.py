@@ -0,0 +1,230 @@
+"""
+Copyright  2016-2021 Maël Azimi <m.a@moul.re>
+
+Silkaj is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Silkaj is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import pytest
+from click.testing import CliRunner
+
+from duniterpy.api import bma
+
+from silkaj import cli, net
+from silkaj.constants import SUCCESS_EXIT_STATUS
+
+PEERS = [
+    {"domain": "a.org", "port": "443", "pubkey": "pubkeyA"},
+    {"domain": "b.org", "port": "443", "pubkey": "pubkeyB"},
+    {"domain": "down.org", "port": "443", "pubkey": "pubkeyC"},
+]
+
+
+def head_message(pubkey, number):
+    return "WS2POCAIC:HEAD:2:{}:{}-HASH:ws2pid:duniter:1.8.1:1.1:20:20".format(
+        pubkey, number
+    )
+
+
+class FakeNetClient:
+    """Main node and peers of the network, counting the peers’ polls"""
+
+    polled = list()
+    heads = [("pubkeyA", 10), ("pubkeyB", 10)]
+
+    def __init__(self, endpoint="BMAS main 443"):
+        self.name = endpoint.split(" ")[1]
+
+    async def __call__(self, request, *args):
+        if request == bma.blockchain.difficulties:
+            return {"levels": [{"uid": "alice", "level": 80}]}
+        if request == bma.wot.members:
+            return {"results": [{"pubkey": "pubkeyA", "uid": "alice"}]}
+        if request == bma.network.ws2p_heads:
+            return {"heads": [{"messageV2": head_message(*h)} for h in self.heads]}
+        if self.name == "down.org":
+            raise OSError("Connection refused")
+        if request == bma.blockchain.current:
+            FakeNetClient.polled.append(self.name)
+            return {"number": 10, "hash": "A" * 64, "time": 1000, "medianTime": 900}
+        return {"duniter": {"version": "1.8.1"}}
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_network(monkeypatch):
+    async def patched_discover_peers(discover):
+        return [dict(peer) for peer in PEERS]
+
+    class patched_ClientInstance:
+        client = FakeNetClient()
+
+    monkeypatch.setattr(net, "discover_peers", patched_discover_peers)
+    monkeypatch.setattr(net, "ClientInstance", patched_ClientInstance)
+    monkeypatch.setattr(net, "PooledClient", FakeNetClient)
+    monkeypatch.setattr(net, "get_terminal_size", lambda: (200, 50))
+    monkeypatch.setattr(FakeNetClient, "polled", list())
+
+
+def test_network_info(fake_network):
+    result = CliRunner().invoke(cli.cli, ["net"])
+    assert result.exit_code == SUCCESS_EXIT_STATUS
+    assert "3 peers ups, with 1 members and 2 non-members" in result.output
+    assert sorted(FakeNetClient.polled) == ["a.org", "b.org"]
+    alice = [line for line in result.output.splitlines() if "alice" in line][0]
+    assert "80" in alice and "1.8.1" in alice and "AAAAAAAAAA…" in alice
+
+
+@pytest.mark.asyncio
+async def test_network_refresh_polls_changed_heads(fake_network, monkeypatch):
+    client = FakeNetClient()
+    heads = await net.get_ws2p_heads(client)
+    assert heads == {"pubkeyA": {"10-HASH"}, "pubkeyB": {"10-HASH"}}
+    monkeypatch.setattr(FakeNetClient, "heads", [("pubkeyA", 10), ("pubkeyB", 11)])
+    new_heads = await net.get_ws2p_heads(client)
+    changed = net.changed_peers(PEERS, heads, new_heads)
+    assert [peer["domain"] for peer in changed] == ["b.org"]
+    assert net.changed_peers(PEERS, heads, None) == PEERS
+
+
+@pytest.mark.asyncio
+async def test_poll_peers(fake_network):
+    infos = [dict(peer) for peer in PEERS]
+    await net.poll_peers(infos)
+    assert [info["block"] for info in infos] == [10, 10, None]
+    assert infos[0]["version"] == "1.8.1"
+    assert infos[2]["version"] is None
+
+
+@pytest.mark.asyncio
+async def test_poll_peer_endpoint(fake_network, monkeypatch):
+    endpoints = list()
+
+    def patched_PooledClient(endpoint):
+        endpoints.append(endpoint)
+        return FakeNetClient(endpoint)
+
+    monkeypatch.setattr(net, "PooledClient", patched_PooledClient)
+    info = {"api": "BMAS", "domain": "a.org", "port": "443", "path": "bma"}
+    info.update(ip4=None, ip6=None, pubkey="pubkeyA")
+    await net.poll_peers([info])
+    assert endpoints == ["BMAS a.org 443 bma"]
+    assert info["block"] == 10
+
+
+def chain_hash(chain, number):
+    """Chains "main", "fork" and "broken" share their blocks below 950"""
+    prefix = {"fork": "F", "broken": "B"}.get(chain, "M") if number >= 950 else "M"
+    return "{}{:063d}".format(prefix, number)
+
+
+class FakeChainClient:
+    """Node on the `chain` branch with its `head`, counting the block requests"""
+
+    requests = list()
+
+    def __init__(self, chain, head):
+        self.chain, self.head = chain, head
+
+    async def __call__(self, request, *args):
+        if request == bma.blockchain.current:
+            return {"number": self.head, "hash": chain_hash(self.chain, self.head)}
+        FakeChainClient.requests.append(args[0])
+        if self.chain == "broken":
+            raise OSError("Connection reset")
+        return {"number": args[0], "hash": chain_hash(self.chain, args[0])}
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.parametrize("height", [950, 951, 1000, 1200])
+@pytest.mark.asyncio
+async def test_fork_point(height, monkeypatch):
+    monkeypatch.setattr(FakeChainClient, "requests", list())
+    fork_point = await net.fork_point(
+        FakeChainClient("main", 2000), FakeChainClient("fork", 2000), height
+    )
+    assert fork_point == 950
+    # bisection instead of a scan, two requests per step
+    assert len(FakeChainClient.requests) <= 2 * (height.bit_length() + 2)
+
+
+@pytest.mark.parametrize(
+    "main, peers, expected",
+    [
+        (
+            ("main", 1000),
+            [("main", 1000), ("main", 999), ("fork", 990)],
+            [
+                "Branch 1: head 1000-M000000000…, 2 peers, with the node",
+                "Branch 2: head 990-F000000000…, 1 peers, forked at block 950",
+                "The node is on the majority branch.",
+            ],
+        ),
+        (
+            ("fork", 990),
+            [("main", 1000), ("main", 1000), ("fork", 990)],
+            [
+                "Branch 1: head 990-F000000000…, 1 peers, with the node",
+                "Branch 2: head 1000-M000000000…, 2 peers, forked at block 950",
+                "The node is not on the majority branch!",
+            ],
+        ),
+        (
+            ("main", 1000),
+            [("main", 1000), ("main", 999), ("broken", 1000)],
+            [
+                "Branch 2: head 1000-B000000000…, 1 peers, fork point unknown",
+                "The node is on the majority branch.",
+            ],
+        ),
+        (
+            ("main", 1000),
+            [("main", 1000), ("main", 998)],
+            ["No fork: the node and its peers are on the same branch."],
+        ),
+    ],
+)
+def test_consensus_info(main, peers, expected, monkeypatch):
+    endpoints = [
+        {
+            "domain": "{}{}.org".format(chain, i),
+            "port": "443",
+            "chain": chain,
+            "head": head,
+        }
+        for i, (chain, head) in enumerate(peers)
+    ]
+
+    async def patched_discover_peers(discover):
+        return endpoints
+
+    class patched_EndPoint:
+        BMA_ENDPOINT = "BMAS main 443"
+
+    def patched_PooledClient(endpoint):
+        if endpoint == patched_EndPoint.BMA_ENDPOINT:
+            return FakeChainClient(*main)
+        ep = [ep for ep in endpoints if ep["domain"] == endpoint.split(" ")[1]][0]
+        return FakeChainClient(ep["chain"], ep["head"])
+
+    monkeypatch.setattr(net, "discover_peers", patched_discover_peers)
+    monkeypatch.setattr(net, "EndPoint", patched_EndPoint)
+    monkeypatch.setattr(net, "PooledClient", patched_PooledClient)
+    result = CliRunner().invoke(cli.cli, ["consensus"])
+    assert result.exit_code == SUCCESS_EXIT_STATUS
+    for line in expected:
+        assert line in result.output
@@ -16,7 +16,22 @@ along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 """
 
 import pytest
+import socket
+from types import SimpleNamespace
+from time import monotonic, time
+from asyncio import start_server, sleep, TimeoutError
+from aiohttp.client_exceptions import ServerDisconnectedError
+from duniterpy.api.errors import DuniterError, HTTP_LIMITATION
+
 from silkaj import network_tools
+from silkaj.network_tools import TokenBucket, start_peers_refresh
+from silkaj.constants import (
+    LEAVES_CONCURRENCY,
+    PEERS_CACHE_TTL,
+    CIRCUIT_BREAKER_FAILURES,
+    CIRCUIT_BREAKER_DELAY,
+    POOL_CONNECTIONS_PER_HOST,
+)
 
 
 @pytest.mark.parametrize(
@@ -31,3 +46,491 @@ from silkaj import network_tools
 )
 def test_check_ip(address, type):
     assert network_tools.check_ip(address) == type
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        (
+            "BMAS g1.duniter.org 443",
+            {"api": "BMAS", "domain": "g1.duniter.org", "port": "443"},
+        ),
+        (
+            "BASIC_MERKLED_API g1.duniter.org 8.8.8.8 2001:db8::1 10901",
+            {
+                "api": "BASIC_MERKLED_API",
+                "domain": "g1.duniter.org",
+                "ip4": "8.8.8.8",
+                "ip6": "2001:db8::1",
+                "port": "10901",
+            },
+        ),
+        (
+            "BMAS g1.duniter.org 443 /bma",
+            {"api": "BMAS", "domain": "g1.duniter.org", "port": "443", "path": "/bma"},
+        ),
+        (
+            "WS2P 1c6f9b6a g1.duniter.org 443 ws2p",
+            {
+                "api": "WS2P",
+                "uuid": "1c6f9b6a",
+                "domain": "g1.duniter.org",
+                "port": "443",
+                "path": "ws2p",
+            },
+        ),
+        (
+            "GVA S g1.duniter.org 443 gva",
+            {"api": "GVA S", "domain": "g1.duniter.org", "port": "443", "path": "gva"},
+        ),
+        ("ES_CORE_API g1.data.duniter.fr 443", None),
+        ("BMAS g1.duniter.org", None),
+        ("BMAS g1.duniter.org 70000", None),
+    ],
+)
+def test_parse_endpoint(raw, expected):
+    ep = network_tools.parse_endpoint(raw)
+    assert ep == expected
+    if expected is not None:
+        assert dict(ep) == expected
+        assert network_tools.parse_endpoint(raw) is ep
+
+
+def test_endpoint_record():
+    ep = network_tools.parse_endpoint("BMAS g1.duniter.org 443")
+    assert "ip6" not in ep and ep.get("ip6") is None and ep.ip6 is None
+    with pytest.raises(KeyError):
+        ep["ip6"]
+    with pytest.raises(AttributeError):
+        ep.port = "80"
+    signed = ep.with_pubkey("pubkey")
+    assert signed["pubkey"] == "pubkey" and "pubkey" not in ep
+    assert len({ep, network_tools.EndpointRecord(**dict(ep))}) == 1
+    assert network_tools.generate_duniterpy_endpoint_format(ep) == (
+        "BMAS g1.duniter.org 443"
+    )
+
+
+def test_parse_endpoints():
+    peers = [
+        {
+            "status": "UP",
+            "pubkey": "pubkey1",
+            "endpoints": [
+                "WS2P 1c6f9b6a g1.duniter.org 443 ws2p",
+                "BMAS g1.duniter.org",
+                "BMAS g1.duniter.org 443",
+            ],
+        },
+        {"status": "DOWN", "pubkey": "pubkey2", "endpoints": ["BMAS g1.down.org 443"]},
+    ]
+    assert network_tools.parse_endpoints(peers) == [
+        {"api": "BMAS", "domain": "g1.duniter.org", "port": "443", "pubkey": "pubkey1"}
+    ]
+
+
+@pytest.mark.parametrize("rate, capacity, requests", [(100, 1, 11), (200, 10, 30)])
+@pytest.mark.asyncio
+async def test_token_bucket(rate, capacity, requests):
+    bucket = network_tools.TokenBucket(rate, capacity)
+    begin = monotonic()
+    for _ in range(requests):
+        await bucket.acquire()
+    assert monotonic() - begin >= (requests - capacity) / rate
+
+
+@pytest.mark.parametrize(
+    "peer, domain, port",
+    [
+        ("g1.duniter.org", "g1.duniter.org", "443"),
+        ("g1.duniter.org:20900", "g1.duniter.org", "20900"),
+        ("[2001:db8::1]:8080", "2001:db8::1", "8080"),
+        ("[2001:db8::1]", "2001:db8::1", "443"),
+    ],
+)
+def test_parse_peer(peer, domain, port):
+    assert network_tools.parse_peer(peer) == {"domain": domain, "port": port}
+
+
+async def listening_server():
+    return await start_server(lambda reader, writer: writer.close(), "127.0.0.1", 0)
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.asyncio
+async def test_probe_endpoint():
+    server = await listening_server()
+    port = str(server.sockets[0].getsockname()[1])
+    address, latency = await network_tools.probe_endpoint(
+        {"ip4": "127.0.0.1", "port": port}
+    )
+    assert address == "ip4" and latency >= 0
+    # ip6 is tried first, but only ip4 accepts the connection
+    address, _ = await network_tools.probe_endpoint(
+        {"ip6": "::1", "ip4": "127.0.0.1", "port": port}
+    )
+    assert address == "ip4"
+    assert await network_tools.probe_endpoint(
+        {"ip4": "127.0.0.1", "port": str(closed_port())}
+    ) == (None, None)
+    server.close()
+
+
+@pytest.mark.asyncio
+async def test_probe_endpoints():
+    server = await listening_server()
+    up = {"ip4": "127.0.0.1", "port": str(server.sockets[0].getsockname()[1])}
+    down = {"ip4": "127.0.0.1", "port": str(closed_port())}
+    probes = await network_tools.probe_endpoints([down, up, down, up], 2)
+    assert [address for address, _ in probes] == [None, "ip4", None, "ip4"]
+    assert await network_tools.reachable_endpoints([down, up]) == [up]
+    assert await network_tools.best_endpoint_address(up, False) == "ip4"
+    assert await network_tools.best_endpoint_address(down, False) is None
+    with pytest.raises(SystemExit):
+        await network_tools.best_endpoint_address(down, True)
+    server.close()
+
+
+def node(name, down=False):
+    return {"domain": name, "port": "443", "pubkey": name.upper(), "down": down}
+
+
+# a → b, c; b → a, d; c → d (down), e; e → f; f → g
+NETWORK = {
+    "a": [node("b"), node("c")],
+    "b": [node("a"), node("d", down=True)],
+    "c": [node("d", down=True), node("e"), node("c")],
+    "e": [node("f")],
+    "f": [node("g")],
+    "g": [],
+}
+
+
+@pytest.mark.parametrize(
+    "max_depth, time_budget, discovered",
+    [
+        (5, 60, ["a", "b", "c", "e", "f", "g"]),
+        (2, 60, ["a", "b", "c", "e"]),
+        (5, 0.2, ["a", "b", "c"]),
+    ],
+)
+@pytest.mark.asyncio
+async def test_crawl_network(max_depth, time_budget, discovered, tmp_path, monkeypatch):
+    queried = list()
+
+    async def patched_get_peers_among_leaves(client, leaves_cache=None):
+        name = client.endpoint.server
+        queried.append(name)
+        if name == "c":
+            await sleep(0.5)
+        return NETWORK[name]
+
+    async def patched_reachable_endpoints(endpoints):
+        return [ep for ep in endpoints if not ep["down"]]
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(
+        network_tools, "get_peers_among_leaves", patched_get_peers_among_leaves
+    )
+    monkeypatch.setattr(
+        network_tools, "reachable_endpoints", patched_reachable_endpoints
+    )
+    endpoints = await network_tools.crawl_network(
+        [node("a")], max_depth, time_budget, workers=2
+    )
+    assert [ep["domain"] for ep in endpoints] == discovered
+    # each node is queried once at most
+    assert len(queried) == len(set(queried))
+
+
+def test_unique_endpoints():
+    endpoints = [node("a"), node("b"), node("a"), dict(node("a"), port="20900")]
+    assert network_tools.unique_endpoints(endpoints) == [
+        node("a"),
+        node("b"),
+        dict(node("a"), port="20900"),
+    ]
+
+
+def peer_document(number):
+    return {
+        "status": "UP",
+        "pubkey": "pubkey{}".format(number),
+        "endpoints": ["BASIC_MERKLED_API node{}.org 80".format(number)],
+    }
+
+
+class FakeLeavesClient:
+    """Serves the peers Merkle tree leaves, counting the concurrent requests"""
+
+    def __init__(self, count):
+        self.leaves = ["leaf{}".format(number) for number in range(count)]
+        self.requested, self.running, self.max_running = list(), 0, 0
+        self.down = set()
+
+    async def __call__(self, request, leaves=False, leaf=None):
+        if leaves:
+            return {"root": str(len(self.leaves)), "leaves": self.leaves}
+        self.requested.append(leaf)
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        await sleep(0.01)
+        self.running -= 1
+        peer = peer_document(int(leaf[4:]))
+        if leaf in self.down:
+            peer["status"] = "DOWN"
+        return {"leaf": {"hash": leaf, "value": peer}}
+
+
+@pytest.mark.asyncio
+async def test_get_peers_among_leaves(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(network_tools, "TokenBucket", lambda: TokenBucket(1000, 1000))
+    client = FakeLeavesClient(20)
+    endpoints = await network_tools.get_peers_among_leaves(client)
+    assert [ep["domain"] for ep in endpoints] == [
+        "node{}.org".format(number) for number in range(20)
+    ]
+    assert sorted(client.requested) == sorted(client.leaves)
+    assert client.max_running == LEAVES_CONCURRENCY
+
+    # unchanged Merkle root: no leaf is requested again
+    client.requested = list()
+    assert await network_tools.get_peers_among_leaves(client) == endpoints
+    assert client.requested == []
+
+    # only the new leaf gets requested
+    client.leaves.append("leaf20")
+    endpoints = await network_tools.get_peers_among_leaves(client)
+    assert client.requested == ["leaf20"]
+    assert endpoints[-1]["pubkey"] == "pubkey20"
+
+    # a peer DOWN for the node is left out, but its status is not cached
+    client.leaves.append("leaf21")
+    client.down.add("leaf21")
+    endpoints = await network_tools.get_peers_among_leaves(client)
+    assert endpoints[-1]["pubkey"] == "pubkey20"
+    assert "status" not in network_tools.LeavesCache().leaves["leaf21"]
+    endpoints = await network_tools.get_peers_among_leaves(client)
+    assert endpoints[-1]["pubkey"] == "pubkey21"
+
+
+def test_peers_cache_unwritable(monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", "/proc/nonexistent")
+    leaves = network_tools.LeavesCache()
+    leaves.leaves["leaf0"] = peer_document(0)
+    leaves.save()
+    assert leaves.path is None
+    cache = network_tools.PeersCache()
+    assert cache.stale() and cache.best() is None
+    cache.record(node("fast"), 0.1, 1000)
+    cache.save()
+    assert cache.best() == node("fast")
+
+
+def test_peers_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    cache = network_tools.PeersCache()
+    assert cache.stale() and cache.best() is None
+    cache.record(node("slow"), 0.5, 1000)
+    cache.record(node("fast"), 0.1, 1000)
+    cache.record(node("late"), 0.01, 990)
+    cache.record(node("down"), 0.001, 1000)
+    cache.record(node("down"), None, None)
+    cache.save()
+
+    cache = network_tools.PeersCache()
+    assert not cache.stale()
+    assert cache.best() == node("fast")
+    # the G1-Test peers are cached apart
+    assert network_tools.PeersCache(gtest=True).best() is None
+
+    # peers which did not succeed within the TTL are not picked anymore
+    now = time()
+    monkeypatch.setattr(network_tools, "time", lambda: now + PEERS_CACHE_TTL)
+    assert cache.stale() and cache.best() is None
+
+
+@pytest.mark.asyncio
+async def test_refresh_peers_cache(tmp_path, monkeypatch):
+    async def patched_probe_endpoints(endpoints):
+        return [(None, None) if ep["down"] else ("domain", 0.1) for ep in endpoints]
+
+    async def patched_get_head_number(ep, semaphore):
+        return None if ep["domain"] == "c" else 1000
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(network_tools, "probe_endpoints", patched_probe_endpoints)
+    monkeypatch.setattr(network_tools, "get_head_number", patched_get_head_number)
+    # b was already probed: its latency is reused
+    probes = {network_tools.endpoint_key(node("b")): ("domain", 0.05)}
+    cache = await network_tools.refresh_peers_cache(
+        [node("a", down=True), node("b"), node("c")], probes=probes
+    )
+    peers = network_tools.PeersCache().peers
+    assert peers == cache.peers
+    assert [
+        ("last_success" in peer, "last_failure" in peer) for peer in peers.values()
+    ] == [(False, True), (True, False), (False, True)]
+    assert cache.best() == node("b")
+    assert cache.ranked()[0]["latency"] == 0.05
+
+
+@pytest.mark.asyncio
+async def test_peers_refresh(monkeypatch):
+    refreshed = list()
+
+    async def patched_refresh_peers(client, gtest):
+        refreshed.append(gtest)
+        await sleep(10)
+
+    monkeypatch.setattr(network_tools, "refresh_peers", patched_refresh_peers)
+    monkeypatch.setattr(
+        network_tools, "EndPoint", lambda: SimpleNamespace(pinned=False, gtest=False)
+    )
+    # the tests disable it, the function imported beforehand is the real one
+    start_peers_refresh(None)
+    start_peers_refresh(None)
+    await sleep(0)
+    assert refreshed == [False]
+    task = network_tools.peers_refresh["task"]
+    await network_tools.stop_peers_refresh(grace=0.01)
+    assert task.cancelled() and network_tools.peers_refresh["task"] is None
+    # a fresh cache is not refreshed
+    network_tools.PeersCache().save()
+    start_peers_refresh(None)
+    assert network_tools.peers_refresh["task"] is None
+
+
+class FakeNodeClient:
+    """Node answering the requests, or failing with its `error`"""
+
+    errors = dict()
+    requests = list()
+
+    def __init__(self, endpoint):
+        self.name = endpoint.split(" ")[1]
+        self.endpoint = endpoint
+
+    async def get(self, url_path, params, rtype, schema):
+        return await self.request("get", url_path)
+
+    async def post(self, url_path, params, rtype, schema):
+        return await self.request("post", url_path)
+
+    async def request(self, method, url_path):
+        FakeNodeClient.requests.append((method, self.name))
+        error = FakeNodeClient.errors.get(self.name)
+        if error:
+            raise error
+        return {"node": self.name, "path": url_path}
+
+    async def close(self):
+        pass
+
+
+async def fake_get(client):
+    return await client.get("blockchain/current")
+
+
+async def fake_post(client):
+    return await client.post("tx/process")
+
+
+@pytest.mark.parametrize(
+    "errors, bma_request, node, requests",
+    [
+        ({}, fake_get, "a", [("get", "a")]),
+        (
+            {"a": ServerDisconnectedError()},
+            fake_get,
+            "b",
+            [("get", "a"), ("get", "b")],
+        ),
+        ({"a": ServerDisconnectedError()}, fake_post, None, [("post", "a")]),
+        (
+            {"a": DuniterError({"ucode": 2001, "message": "No member"})},
+            fake_get,
+            None,
+            [("get", "a")],
+        ),
+        (
+            {"a": DuniterError({"ucode": HTTP_LIMITATION, "message": "Limit"})},
+            fake_get,
+            "b",
+            [("get", "a"), ("get", "b")],
+        ),
+        (
+            {"a": ValueError("Error 502 Bad Gateway")},
+            fake_get,
+            "b",
+            [("get", "a"), ("get", "b")],
+        ),
+        ({"a": ValueError("Error 503")}, fake_post, None, [("post", "a")]),
+        (
+            {"a": TimeoutError(), "b": TimeoutError()},
+            fake_get,
+            None,
+            [("get", "a"), ("get", "b")],
+        ),
+    ],
+)
+@pytest.mark.asyncio
+async def test_failover_client(errors, bma_request, node, requests, monkeypatch):
+    monkeypatch.setattr(network_tools, "PooledClient", FakeNodeClient)
+    monkeypatch.setattr(FakeNodeClient, "errors", errors)
+    monkeypatch.setattr(FakeNodeClient, "requests", list())
+    client = network_tools.FailoverClient([node_ep("a"), node_ep("b")], [None, 0.5])
+    if node is None:
+        with pytest.raises(type(errors["a"])):
+            await client(bma_request)
+    else:
+        assert (await client(bma_request))["node"] == node
+    assert FakeNodeClient.requests == requests
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_failover_client_circuit_breaker(monkeypatch):
+    monkeypatch.setattr(network_tools, "PooledClient", FakeNodeClient)
+    monkeypatch.setattr(FakeNodeClient, "errors", {"a": ServerDisconnectedError()})
+    client = network_tools.FailoverClient([node_ep("a"), node_ep("b"), node_ep("c")])
+    for _ in range(CIRCUIT_BREAKER_FAILURES):
+        await client(fake_get)
+    # a’s circuit is open: the requests go to the fastest of the others
+    monkeypatch.setattr(FakeNodeClient, "requests", list())
+    client.nodes[1].latency, client.nodes[2].latency = 1, 0.01
+    assert (await client(fake_get))["node"] == "c"
+    assert FakeNodeClient.requests == [("get", "c")]
+    # a gets tried again once the delay elapsed, and recovers
+    now = monotonic()
+    monkeypatch.setattr(network_tools, "monotonic", lambda: now + CIRCUIT_BREAKER_DELAY)
+    monkeypatch.setattr(FakeNodeClient, "errors", {})
+    client.nodes[0].latency = None
+    assert (await client(fake_get))["node"] == "a"
+    assert client.nodes[0].available() and client.nodes[0].failures == 0
+
+
+def node_ep(name):
+    return {"domain": name, "port": "443"}
+
+
+@pytest.mark.asyncio
+async def test_pooled_clients_share_session():
+    first = network_tools.PooledClient("BMAS a.org 443")
+    second = network_tools.PooledClient("BMAS b.org 443")
+    assert first.session is second.session
+    connector = first.session.connector
+    assert connector.limit_per_host == POOL_CONNECTIONS_PER_HOST
+    assert connector.use_dns_cache
+    await first.close()
+    assert not second.session.closed
+    await network_tools.close_shared_session()
+    assert second.session.closed
+    assert not network_tools.PooledClient("BMAS a.org 443").session.closed
+    await network_tools.close_shared_session()
@@ -80,3 +80,6 @@ def test_display_pubkey_and_checksum(pubkey, checksum):
     assert pubkey[:14] + "…:" + checksum == display_pubkey_and_checksum(
         pubkey, short=True, length=14
     )
+    assert pubkey + ":" + checksum == display_pubkey_and_checksum(
+        pubkey, checksum=checksum
+    )
@@ -15,22 +15,47 @@ You should have received a copy of the GNU Affero General Public License
 along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 """
 
+import re
+import json
 import pytest
+from asyncio import Queue, ensure_future
+from concurrent.futures import ProcessPoolExecutor
 from click.testing import CliRunner
+from aiohttp.client_exceptions import ServerDisconnectedError
 
 from duniterpy.documents import Block
 from duniterpy.api.client import Client
 from duniterpy.api import bma
+from duniterpy.api.errors import DuniterError
+from duniterpy.api.endpoint import endpoint
 
-from silkaj.network_tools import EndPoint
+from silkaj.network_tools import EndPoint, TokenBucket
 from silkaj import cli
 from silkaj.blocks import (
     check_passed_blocks_range,
     get_chunk_size,
     get_chunk,
+    ChunkFetcher,
+    MultiNodeFetcher,
+    fetch_chunks,
+    verify_chunk,
+    verification_executor,
+    verify_signed_raws,
+    merge_report,
     verify_block_signature,
+    verify_raw_signature,
     display_result,
+    display_chain_result,
+    load_checkpoint,
+    save_checkpoint,
+    CHUNK_MIN_SIZE,
+    CHUNK_TARGET_LATENCY,
+    MAX_RETRIES,
+    BACKOFF_BASE,
+    BACKOFF_MAX,
 )
+from silkaj.blocks_store import BlocksStore
+from benchmark_verify import gen_corpus, run_benchmark
 from silkaj.constants import (
     SUCCESS_EXIT_STATUS,
     FAILURE_EXIT_STATUS,
@@ -43,7 +68,7 @@ HEAD_BLOCK = 48000
 
 
 async def current(self):
-    return {"number": HEAD_BLOCK}
+    return {"number": HEAD_BLOCK, "currency": "g1"}
 
 
 @pytest.mark.parametrize(
@@ -77,7 +102,8 @@ async def test_check_passed_blocks_range(from_block, to_block, capsys, monkeypat
         (HEAD_BLOCK - 1, 0),
     ],
 )
-def test_verify_blocks_signatures(from_block, to_block, monkeypatch):
+def test_verify_blocks_signatures(from_block, to_block, tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
     monkeypatch.setattr(bma.blockchain, "current", current)
     result = CliRunner().invoke(cli.cli, ["verify", str(from_block), str(to_block)])
     assert result.exit_code == SUCCESS_EXIT_STATUS
@@ -97,6 +123,7 @@ def test_verify_blocks_signatures(from_block, to_block, monkeypatch):
         (140, 15150, [140, 5140, 10140, 15140], 140),
         (140, 15150, [140, 5140, 10140, 15140], 15140),
         (0, 2, [0], 0),
+        (0, 9999, [0, 5000], 5000),
     ],
 )
 def test_get_chunk_size(from_block, to_block, chunks_from, chunk_from):
@@ -116,6 +143,187 @@ async def test_get_chunks(chunk_size, chunk_from):
     await client.close()
 
 
+async def fake_client(request, count, start):
+    if start > HEAD_BLOCK:
+        raise ValueError("No block found")
+    return [{"number": number} for number in range(start, start + count)]
+
+
+@pytest.mark.parametrize(
+    "from_block, to_block, prefetch",
+    [(0, 12000, 1), (140, 15150, 2), (HEAD_BLOCK - 10, HEAD_BLOCK, 3)],
+)
+@pytest.mark.asyncio
+async def test_fetch_chunks(from_block, to_block, prefetch, tmp_path):
+    store = BlocksStore("g1", HEAD_BLOCK, tmp_path / "blocks.sqlite")
+    chunks = Queue(prefetch)
+    chunks_from = range(from_block, to_block + 1, BMA_MAX_BLOCKS_CHUNK_SIZE)
+    fetcher = ensure_future(
+        fetch_chunks(
+            ChunkFetcher(fake_client), store, from_block, to_block, chunks_from, chunks
+        )
+    )
+    numbers = list()
+    for _ in chunks_from:
+        assert chunks.qsize() <= prefetch
+        chunk = await chunks.get()
+        numbers.extend(block["number"] for block in chunk)
+    await fetcher
+    store.close()
+    assert numbers == list(range(from_block, to_block + 1))
+
+
+@pytest.mark.asyncio
+async def test_fetch_chunks_error(tmp_path):
+    store = BlocksStore("g1", HEAD_BLOCK, tmp_path / "blocks.sqlite")
+    chunks = Queue(1)
+    chunks_from = range(HEAD_BLOCK + 1, HEAD_BLOCK + 2)
+    await fetch_chunks(
+        ChunkFetcher(fake_client),
+        store,
+        HEAD_BLOCK + 1,
+        HEAD_BLOCK + 1,
+        chunks_from,
+        chunks,
+    )
+    store.close()
+    assert isinstance(await chunks.get(), ValueError)
+
+
+@pytest.mark.parametrize(
+    "latency, size, expected",
+    [
+        (CHUNK_TARGET_LATENCY + 1, BMA_MAX_BLOCKS_CHUNK_SIZE, 2500),
+        (CHUNK_TARGET_LATENCY + 1, CHUNK_MIN_SIZE, CHUNK_MIN_SIZE),
+        (CHUNK_TARGET_LATENCY * 3 / 4, 1000, 1000),
+        (0.1, 1000, 1500),
+        (0.1, BMA_MAX_BLOCKS_CHUNK_SIZE, BMA_MAX_BLOCKS_CHUNK_SIZE),
+    ],
+)
+def test_chunk_fetcher_adapt(latency, size, expected):
+    fetcher = ChunkFetcher(fake_client)
+    fetcher.size = size
+    fetcher.adapt(latency)
+    assert fetcher.size == expected
+
+
+@pytest.mark.parametrize("failures", [0, 2, MAX_RETRIES, MAX_RETRIES + 1])
+@pytest.mark.asyncio
+async def test_chunk_fetcher_retries(failures, monkeypatch):
+    delays, requests = list(), list()
+
+    async def patched_sleep(delay):
+        delays.append(delay)
+
+    async def failing_client(request, count, start):
+        requests.append((count, start))
+        if len(requests) <= failures:
+            raise ServerDisconnectedError()
+        return await fake_client(request, count, start)
+
+    monkeypatch.setattr("silkaj.blocks.sleep", patched_sleep)
+    fetcher = ChunkFetcher(failing_client, TokenBucket(1000, 1000))
+    if failures > MAX_RETRIES:
+        with pytest.raises(ServerDisconnectedError):
+            await fetcher.get_chunk(10000, 0)
+        return
+    chunk = await fetcher.get_chunk(10000, 0)
+    assert [block["number"] for block in chunk] == list(range(10000))
+    assert len(delays) == failures
+    for attempt, delay in enumerate(delays, start=1):
+        assert delay <= min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    # chunks size halved on each failure
+    assert requests[failures][0] == max(
+        CHUNK_MIN_SIZE, BMA_MAX_BLOCKS_CHUNK_SIZE // 2 ** failures
+    )
+
+
+@pytest.mark.parametrize("chunk_from", [HEAD_BLOCK - 100, HEAD_BLOCK + 1])
+@pytest.mark.asyncio
+async def test_chunk_fetcher_short_chunk(chunk_from):
+    async def short_client(request, count, start):
+        if start > HEAD_BLOCK:
+            return list()
+        return await fake_client(request, min(count, HEAD_BLOCK + 1 - start), start)
+
+    fetcher = ChunkFetcher(short_client, TokenBucket(1000, 1000))
+    with pytest.raises(ValueError, match="Node returned no blocks from block 48001"):
+        await fetcher.get_chunk(BMA_MAX_BLOCKS_CHUNK_SIZE, chunk_from)
+
+
+@pytest.mark.asyncio
+async def test_chunk_fetcher_duniter_error():
+    async def erroneous_client(request, count, start):
+        raise DuniterError({"ucode": 2001, "message": "No matching identity"})
+
+    fetcher = ChunkFetcher(erroneous_client, TokenBucket(1000, 1000))
+    with pytest.raises(DuniterError):
+        await fetcher.get_chunk(BMA_MAX_BLOCKS_CHUNK_SIZE, 0)
+
+
+class FakeNode:
+    """Node serving fake blocks, failing or forked if asked"""
+
+    def __init__(self, name, down=False, forked=False):
+        self.endpoint = endpoint("BMAS {} 443".format(name))
+        self.down, self.forked, self.requested = down, forked, list()
+
+    async def __call__(self, request, *args):
+        if self.down:
+            raise ServerDisconnectedError()
+        if request == bma.blockchain.block:
+            blocks = await fake_client(request, 1, args[0])
+        else:
+            self.requested.append(args[1])
+            blocks = await fake_client(request, *args)
+        for block in blocks:
+            block["hash"] = "forked" if self.forked else str(block["number"])
+        return blocks[0] if request == bma.blockchain.block else blocks
+
+
+@pytest.mark.parametrize(
+    "nodes",
+    [
+        [FakeNode("a"), FakeNode("b"), FakeNode("c")],
+        [FakeNode("a"), FakeNode("b", down=True), FakeNode("c")],
+        [FakeNode("a", down=True), FakeNode("b", down=True)],
+        [FakeNode("a"), FakeNode("b", forked=True)],
+    ],
+)
+@pytest.mark.asyncio
+async def test_multi_node_fetcher(nodes, tmp_path, monkeypatch):
+    async def patched_sleep(delay):
+        pass
+
+    monkeypatch.setattr("silkaj.blocks.sleep", patched_sleep)
+    store = BlocksStore("g1", HEAD_BLOCK, tmp_path / "blocks.sqlite")
+    fetcher = MultiNodeFetcher(nodes, store.last_stable_number)
+    assert fetcher.concurrency == len(nodes)
+    chunks = Queue(2)
+    chunks_from = range(0, 30000, BMA_MAX_BLOCKS_CHUNK_SIZE)
+    producer = ensure_future(
+        fetch_chunks(fetcher, store, 0, 29999, chunks_from, chunks)
+    )
+    numbers = list()
+    for _ in chunks_from:
+        chunk = await chunks.get()
+        if isinstance(chunk, Exception):
+            break
+        numbers.extend(block["number"] for block in chunk)
+    await producer
+    store.close()
+
+    healthy = [node for node in nodes if not node.down]
+    if not healthy:
+        assert str(chunk).startswith("No node left to download blocks")
+    elif any(node.forked for node in nodes):
+        assert "hash differs between nodes" in str(chunk)
+    else:
+        assert numbers == list(range(30000))
+        # chunks spread over the healthy nodes
+        assert all(node.requested for node in healthy)
+
+
 invalid_signature = "fJusVDRJA8akPse/sv4uK8ekUuvTGj1OoKYVdMQQAACs7OawDfpsV6cEMPcXxrQTCTRMrTN/rRrl20hN5zC9DQ=="
 invalid_block_raw = "Version: 10\nType: Block\nCurrency: g1\nNumber: 15144\nPoWMin: 80\n\
 Time: 1493683741\nMedianTime: 1493681008\nUnitBase: 0\n\
@@ -154,6 +362,106 @@ def test_verify_block_signature(signature, block_raw):
         assert invalid_signatures_blocks == []
 
 
+def gen_chained_blocks(count, broken=None, wrong_hash=None, tampered=None):
+    """Chain copies of the valid block, with an unlinked block
+    at `broken` number, a wrong hash at `wrong_hash` number and
+    a block body changed after its InnerHash computation at `tampered` number"""
+    blocks, previous_hash = list(), valid_block_raw.split("PreviousHash: ")[1][:64]
+    for number in range(1, count + 1):
+        raw = valid_block_raw.replace("Number: 509002", "Number: {}".format(number))
+        raw = raw.replace("Nonce: 10099900003511", "Nonce: {}".format(number))
+        if number != broken:
+            raw = raw.replace(
+                valid_block_raw.split("PreviousHash: ")[1][:64], previous_hash
+            )
+        block = Block.from_signed_raw(raw + valid_signature + "\n")
+        raw = raw.replace(block.inner_hash, block.computed_inner_hash())
+        if number == tampered:
+            raw = raw.replace("MembersCount: 11", "MembersCount: 12")
+        block = Block.from_signed_raw(raw + valid_signature + "\n")
+        previous_hash = block.proof_of_work()
+        blocks.append(
+            {
+                "raw": raw,
+                "signature": valid_signature,
+                "hash": "0" * 64 if number == wrong_hash else previous_hash,
+            }
+        )
+    return blocks
+
+
+@pytest.mark.parametrize("jobs", [1, 2, 3])
+@pytest.mark.asyncio
+async def test_verify_chunk(jobs):
+    invalid_block = {
+        "raw": invalid_block_raw,
+        "signature": invalid_signature,
+        "hash": "",
+    }
+    valid_block = {"raw": valid_block_raw, "signature": valid_signature, "hash": ""}
+    chunk = [valid_block, invalid_block, valid_block, invalid_block, valid_block]
+    executor = verification_executor(jobs)
+    reports = await verify_chunk(executor, jobs, chunk)
+    executor.shutdown()
+    assert len(reports) == min(jobs, len(chunk))
+    invalid_blocks_signatures = [
+        number for report in reports for number in report["invalid_blocks_signatures"]
+    ]
+    assert invalid_blocks_signatures == [G1_INVALID_BLOCK_SIG, G1_INVALID_BLOCK_SIG]
+
+
+@pytest.mark.parametrize(
+    "jobs, broken, wrong_hash, tampered",
+    [
+        (1, None, None, None),
+        (2, 3, None, None),
+        (3, 4, 6, None),
+        (4, None, 2, None),
+        (2, 5, 5, None),
+        (1, None, None, 7),
+        (3, None, 2, 8),
+    ],
+)
+@pytest.mark.asyncio
+async def test_verify_chunk_chain(jobs, broken, wrong_hash, tampered):
+    blocks = gen_chained_blocks(10, broken, wrong_hash, tampered)
+    checkpoint = {
+        "invalid_blocks_signatures": list(),
+        "last_hash": None,
+        "wrong_hashes": list(),
+        "chain_breaks": list(),
+    }
+    executor = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    # two chunks, to check the link at the chunks boundary
+    for chunk in (blocks[:5], blocks[5:]):
+        for report in await verify_chunk(executor, jobs, chunk, True):
+            merge_report(checkpoint, report)
+    if executor:
+        executor.shutdown()
+    assert checkpoint["chain_breaks"] == ([broken] if broken else [])
+    assert checkpoint["wrong_hashes"] == [n for n in (wrong_hash, tampered) if n]
+    assert checkpoint["last_hash"] == blocks[-1]["hash"] or wrong_hash == 10
+
+
+@pytest.mark.parametrize(
+    "wrong_hashes, chain_breaks", [([], []), ([53], []), ([], [12, 14]), ([3], [4])]
+)
+def test_display_chain_result(wrong_hashes, chain_breaks, capsys):
+    display_chain_result(100, 500, wrong_hashes, chain_breaks)
+    captured = capsys.readouterr()
+    expected = "Within 100-500 range, "
+    if wrong_hashes or chain_breaks:
+        expected += "blocks with a wrong hash: {}, ".format(
+            " ".join(str(n) for n in wrong_hashes) or "none"
+        )
+        expected += "blocks not linked to the previous one: {}".format(
+            " ".join(str(n) for n in chain_breaks) or "none"
+        )
+    else:
+        expected += "the blocks’ hash chain is intact."
+    assert expected + "\n" == captured.out
+
+
 @pytest.mark.parametrize(
     "from_block, to_block, invalid_blocks_signatures",
     [(0, 5, []), (100, 500, [53]), (470, 2341, [243, 453])],
@@ -168,3 +476,147 @@ def test_display_result(from_block, to_block, invalid_blocks_signatures, capsys)
     display_result(from_block, to_block, invalid_blocks_signatures)
     captured = capsys.readouterr()
     assert expected + "\n" == captured.out
+
+
+def test_checkpoint(tmp_path):
+    path = tmp_path / "checkpoint.json"
+    assert load_checkpoint(path) is None
+    checkpoint = {
+        "currency": "g1",
+        "from_block": 0,
+        "to_block": HEAD_BLOCK,
+        "last_verified": 19999,
+        "invalid_blocks_signatures": [G1_INVALID_BLOCK_SIG],
+    }
+    save_checkpoint(path, checkpoint)
+    assert load_checkpoint(path) == checkpoint
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_verify_resume_without_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    result = CliRunner().invoke(cli.cli, ["verify", "--resume"])
+    assert result.exit_code == FAILURE_EXIT_STATUS
+    assert "No interrupted verification to resume\n" == result.output
+
+
+def test_verify_interrupted_and_resumed(tmp_path, monkeypatch):
+    head, invalid_numbers, requested, interrupted = 12000, (700, 7000), list(), []
+
+    async def patched_current(client):
+        return {"number": head, "currency": "g1"}
+
+    async def patched_blocks(client, count, start):
+        requested.append(start)
+        if start == 5001 and not interrupted:
+            interrupted.append(start)
+            raise ValueError("Interrupted")
+        chunk = list()
+        for number in range(start, start + count):
+            raw = invalid_block_raw if number in invalid_numbers else valid_block_raw
+            raw = re.sub("Number: [0-9]+", "Number: {}".format(number), raw)
+            signature = (
+                invalid_signature if number in invalid_numbers else valid_signature
+            )
+            chunk.append(
+                {"number": number, "raw": raw, "signature": signature, "hash": ""}
+            )
+        return chunk
+
+    async def patched_block(client, number):
+        return {"number": number, "hash": ""}
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(bma.blockchain, "current", patched_current)
+    monkeypatch.setattr(bma.blockchain, "blocks", patched_blocks)
+    # The stored blocks tip is checked when resuming
+    monkeypatch.setattr(bma.blockchain, "block", patched_block)
+    checkpoint_path = tmp_path / "silkaj" / "verify_checkpoint.json"
+
+    result = CliRunner().invoke(cli.cli, ["verify", "1", "--jobs", "1"])
+    assert result.exit_code != SUCCESS_EXIT_STATUS
+    checkpoint = load_checkpoint(checkpoint_path)
+    assert checkpoint["last_verified"] == 5000
+    assert checkpoint["invalid_blocks_signatures"] == [700]
+
+    del requested[:]
+    result = CliRunner().invoke(cli.cli, ["verify", "--jobs", "1", "--resume"])
+    assert result.exit_code == SUCCESS_EXIT_STATUS
+    assert min(requested) == checkpoint["last_verified"] + 1
+    assert (
+        "Within 1-{} range, blocks with a wrong signature: 700 7000\n".format(head)
+        in result.output
+    )
+    assert not checkpoint_path.exists()
+
+
+@pytest.mark.parametrize("jobs, chain", [(1, False), (1, True), (2, True)])
+def test_benchmark_verify(jobs, chain):
+    corpus = gen_corpus(120, invalid=[7, 80])
+    measures = run_benchmark(corpus, jobs, chain)
+    assert "blocks with a wrong signature: 7 80" in measures["output"]
+    if chain:
+        assert "the blocks’ hash chain is intact" in measures["output"]
+    assert measures["blocks"] == 120
+    assert measures["requests"] == 2
+    assert (measures["verify"] is None) == (jobs > 1)
+
+
+@pytest.mark.parametrize("chain", [False, True])
+def test_verify_jsonl_format(chain):
+    corpus = gen_corpus(120, invalid=[7, 80])
+    output = run_benchmark(corpus, 1, chain, ["--format", "jsonl"])["output"]
+    records = [json.loads(line) for line in output.splitlines()]
+    assert len(records) == 2
+    chunk, summary = records
+    assert chunk["type"] == "chunk"
+    assert (chunk["from_block"], chunk["to_block"]) == (1, 120)
+    assert chunk["invalid_blocks_signatures"] == [7, 80]
+    assert chunk["blocks_per_second"] > 0
+    assert summary == dict(
+        {"type": "summary", "from_block": 1, "to_block": 120},
+        invalid_blocks_signatures=2,
+        **({"wrong_hashes": 0, "chain_breaks": 0} if chain else {})
+    )
+    assert ("chain_breaks" in chunk) == chain
+
+
+@pytest.mark.parametrize(
+    "raw, signature, valid",
+    [
+        (valid_block_raw, valid_signature, True),
+        (valid_block_raw, invalid_signature, False),
+        (invalid_block_raw, invalid_signature, False),
+        (valid_block_raw.replace("Nonce: ", "Nonce:"), valid_signature, False),
+        (valid_block_raw.replace("\nIssuer: ", "\n"), valid_signature, False),
+        (valid_block_raw, "not base64", False),
+    ],
+)
+def test_verify_raw_signature(raw, signature, valid):
+    keys = dict()
+    assert verify_raw_signature(keys, raw, signature) == valid
+    assert verify_raw_signature(keys, raw, signature) == valid
+
+
+@pytest.mark.parametrize("full_parse", [False, True])
+def test_verify_signed_raws_fallback(full_parse, monkeypatch):
+    invalid_number = Block.from_signed_raw(
+        invalid_block_raw + invalid_signature + "\n"
+    ).number
+    parsed = list()
+    from_signed_raw = Block.from_signed_raw
+
+    def patched_from_signed_raw(signed_raw):
+        block = from_signed_raw(signed_raw)
+        parsed.append(block.number)
+        return block
+
+    monkeypatch.setattr(Block, "from_signed_raw", patched_from_signed_raw)
+    blocks = [
+        (valid_block_raw, valid_signature, ""),
+        (invalid_block_raw, invalid_signature, ""),
+    ]
+    report = verify_signed_raws(blocks, full_parse=full_parse)
+    assert report["invalid_blocks_signatures"] == [invalid_number]
+    # Only the block failing the fast path check gets parsed
+    assert len(parsed) == (2 if full_parse else 1)
@@ -15,10 +15,14 @@ You should have received a copy of the GNU Affero General Public License
 along with Silkaj. If not, see <https://www.gnu.org/licenses/>.
 """
 
+import json
 import pytest
 import click
+from types import SimpleNamespace
+from collections import OrderedDict
+from duniterpy.api.errors import DuniterError, NO_MEMBER_MATCHING_PUB_OR_UID
 
-from silkaj import wot
+from silkaj import tools, wot
 
 
 pubkey_titi_tata = "B4RoF48cTxzmsQDB3UjodKdZ2cVymKSKzgiPVRoMeA88"
@@ -175,3 +179,67 @@ async def test_choose_identity(
                 assert " 01 " in captured.out
             for uid in lookup["uids"]:
                 assert uid["uid"] in captured.out
+
+
+@pytest.mark.asyncio
+async def test_identity_of_cache(tmp_path, monkeypatch):
+    requests = list()
+
+    async def client(request, pubkey_uid):
+        requests.append(pubkey_uid)
+        if pubkey_uid == pubkey_toto_tutu:
+            raise DuniterError(
+                {"ucode": NO_MEMBER_MATCHING_PUB_OR_UID, "message": "No member"}
+            )
+        return titi
+
+    cache = wot.IdentityCache()
+    monkeypatch.setattr(cache, "memory", OrderedDict())
+    monkeypatch.setattr(cache, "disk", dict())
+    monkeypatch.setattr(cache, "source", "g1")
+    monkeypatch.setattr(cache, "persistent", True)
+    monkeypatch.setattr(cache, "path", tmp_path / wot.IDENTITY_CACHE_FILENAME)
+    monkeypatch.setattr(cache, "dirty", False)
+    monkeypatch.setattr(tools, "command_end_callbacks", list())
+    monkeypatch.setattr(wot, "ClientInstance", lambda: SimpleNamespace(client=client))
+    monkeypatch.setattr(wot, "IDENTITY_CACHE_SIZE", 1)
+
+    for _ in range(2):
+        assert await wot.identity_of(pubkey_titi_tata) == titi
+        assert await wot.is_member(pubkey_toto_tutu) is False
+    assert requests == [pubkey_titi_tata, pubkey_toto_tutu]
+    assert list(cache.memory) == [pubkey_toto_tutu]
+
+    # The identities are written once, at the end of the command
+    assert not cache.path.exists()
+    assert tools.command_end_callbacks == [cache.save]
+    tools.command_end_callbacks.pop()()
+    assert cache.path.exists() and not cache.dirty
+
+    # The evicted identity is served by the disk tier
+    cache.memory.clear()
+    cache.disk = json.loads(cache.path.read_text())
+    assert await wot.identity_of(pubkey_titi_tata) == titi
+    assert len(requests) == 2
+
+    # The checks before sending a document bypass the cache
+    assert await wot.is_member(pubkey_titi_tata, cached=False) == titi
+    assert len(requests) == 3
+
+    # The negative entries expire first
+    monkeypatch.setattr(wot, "IDENTITY_NEGATIVE_TTL", 0)
+    with pytest.raises(DuniterError):
+        await wot.identity_of(pubkey_toto_tutu)
+    assert await wot.identity_of(pubkey_titi_tata) == titi
+    assert requests[3:] == [pubkey_toto_tutu]
+
+    # Only the requests are paced
+    sleeps = list()
+
+    async def patched_sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(wot, "sleep", patched_sleep)
+    pubkeys = [pubkey_titi_tata, pubkey_toto_tutu]
+    assert await wot.identities_from_pubkeys(pubkeys, True) == [titi]
+    assert requests[4:] == [pubkey_toto_tutu] and len(sleeps) == 1